@@ -0,0 +1,146 @@
+import asyncio
+import aiohttp
+
+from cmdi_record import CMDIRecord, info_value, resource_ref
+from datetime import datetime
+
+
+# quick health sweep: checks whether every CMDI and resource is online and compares the
+# Content-Length to the CMDI Size, without downloading any resource
+class AvailabilityCheck:
+
+    def __init__(self, username, password, concurrency=200, per_host=100, timeout=60):
+        self.username = username
+        self.password = password
+        self.session_start = datetime.now()
+        self.errors = {}
+        # number of checks running at the same time and max. number of connections per host
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+
+    async def login(self, session):
+        async with session.post('https://talar.sfb833.uni-tuebingen.de/erdora/login',
+                data = {"username": self.username, "password": self.password}) as post:
+            pass
+
+    async def _session_duration(self, session):
+        async with self._lock:
+            now = datetime.now()
+            diff = now - self.session_start
+            if diff.total_seconds()/3600 >= 1:
+                self.session_start = datetime.now()
+                await self.login(session)
+
+    def add_error(self, error, cmdi):
+        if '@' in cmdi:
+            cmdi_handle = cmdi.split('@')[0]
+        else:
+            cmdi_handle = cmdi
+        if self.errors.get(cmdi_handle) is None:
+            self.errors[cmdi_handle] = []
+        self.errors[cmdi_handle].append(error)
+
+    # records: iterable of OAI records, e.g. OAIHarvester.records() or iter_records(OAI.xml)
+    def validate_oai(self, records):
+        self.errors = {}
+        asyncio.run(self._validate_oai(iter(records)))
+        print(f"Finished, {len(self.errors)} CMDI files affected")
+        return self.errors
+
+    async def _validate_oai(self, records):
+        self._lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await self.login(session)
+            pending = set()
+            while True:
+                # records are harvested and parsed in a thread, so the checks keep running meanwhile
+                checks = await loop.run_in_executor(None, self._next_checks, records)
+                if checks is None:
+                    break
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    self._raise_failures(done)
+                pending.add(asyncio.create_task(self._check_record(session, checks)))
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                self._raise_failures(done)
+
+    # a failed task (e.g. the re-login) means the check is incomplete
+    def _raise_failures(self, done):
+        failures = [task.exception() for task in done if task.exception() is not None]
+        if failures:
+            raise failures[0]
+
+    # returns (url, size, is_resource) of the CMDI and its resources for the next record
+    def _next_checks(self, records):
+        cmdi = next(records, None)
+        if cmdi is None:
+            return None
+
+        record = CMDIRecord(cmdi)
+        checks = [(record.handle, None, False)]
+        for res_proxy in record.resources:
+            resource = record.info(res_proxy)
+            size = None
+            if resource is not None:
+                size = info_value(resource, "Size")
+            checks.append((resource_ref(res_proxy), size, True))
+        return checks
+
+    # checks: (url, size, is_resource) of _next_checks; the resources are only checked
+    # if the CMDI page is online, otherwise the record has a single error
+    async def _check_record(self, session, checks):
+        cmdi_handle, size, resource = checks[0]
+        if await self._check(session, cmdi_handle, cmdi_handle, size, resource):
+            await asyncio.gather(*(self._check(session, cmdi_handle, *check) for check in checks[1:]))
+
+    # sometimes the connection to TALAR is suddenly lost
+    # try connecting to an URL at least 3 times; returns False if the URL is not reachable;
+    # size mismatches are keyed by the CMDI handle, like the checksum errors of repo_eval.py
+    async def _check(self, session, cmdi_handle, url, size, resource):
+        await self._session_duration(session)
+        for i in range(3):
+            try:
+                length = await self._request(session, url, head=not resource)
+                break
+            except Exception:
+                continue
+        else:
+            self.add_error(f"{url};404", url)
+            print(f"{url};404")
+            return False
+
+        if resource and size and length is not None and str(length) != str(size):
+            self.add_error(f"{url};size;CMDI: {size};Computed: {length}", cmdi_handle)
+            print(f"{url};size;CMDI: {size};Computed: {length}")
+        return True
+
+    # CMDI pages: HEAD, resources: GET of the first byte only, the full size is in Content-Range;
+    # returns the size of the URL (None if unknown)
+    async def _request(self, session, url, head):
+        if head:
+            request = session.head(url, allow_redirects=True)
+        else:
+            request = session.get(url, headers={"Range": "bytes=0-0"}, allow_redirects=True)
+        async with request as r:
+            # the server doesn't allow HEAD
+            if not (head and r.status in (405, 501)):
+                r.raise_for_status()
+                return self._content_length(r)
+        return await self._request(session, url, head=False)
+
+    def _content_length(self, r):
+        content_range = r.headers.get("Content-Range")
+        if content_range is not None and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1].strip()
+            if total.isdigit():
+                return int(total)
+        # server ignored the Range header
+        if r.status == 200:
+            return r.content_length
+        return None
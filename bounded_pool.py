@@ -0,0 +1,65 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# thread pool that queues at most 2 tasks per worker: submit() blocks until a slot is free,
+# so the producer (e.g. the harvest) doesn't run ahead of the workers and records are not
+# held in memory longer than necessary; failed tasks are printed and counted
+class BoundedExecutor:
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.slots = threading.BoundedSemaphore(self.workers * 2)
+        # number of finished tasks without resp. with an exception
+        self.succeeded = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            if future.exception() is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+        self.slots.release()
+        if future.exception() is not None:
+            print(f"Worker failure: {future.exception()!r}")
+
+    # raises if a task failed, so an incomplete check is not taken for a complete one
+    # (e.g. saved as checked in the record store)
+    def raise_failures(self):
+        if self.failed:
+            raise RuntimeError(f"{self.failed} of {self.succeeded + self.failed} tasks failed")
+
+    # waits for all submitted tasks
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+# calls fn(*args) for every args tuple of items with a BoundedExecutor of workers threads,
+# returns the number of calls that succeeded; strict: raise if a call failed
+def bounded_map(fn, items, workers=1, strict=False):
+    with BoundedExecutor(workers) as pool:
+        for args in items:
+            pool.submit(fn, *args)
+    if strict:
+        pool.raise_failures()
+    return pool.succeeded
@@ -4,98 +4,78 @@ import getpass
 import json
 from json.decoder import JSONDecodeError
 import os
-import requests
 import urllib3
 
+from bounded_pool import bounded_map
 from datetime import datetime
-import xml.etree.ElementTree as ET
+from handle_cache import HandleCache
+from oai_harvester import OAIHarvester, iter_records
+from record_store import RecordStore
+from talar_session import TalarSession
 
 
 
+class OAIEval(TalarSession):
 
-class OAIEval:
+    def __init__(self, username, password, acl_restricted='acl_restricted.txt', workers=1, handles=None):
+        # workers: number of resources whose ACL is retrieved at the same time
+        super().__init__(username, password, workers)
+        # optional HandleCache, handles are only resolved if they are not cached
+        self.handles = handles
 
-    def __init__(self, username, password, acl_restricted='acl_restricted.txt'):
-        self.username = username
-        self.password = password 
-        self.session_start = datetime.now()
-        self.errors = {}
-
-    def login(self):
-        with requests.Session() as session:
-            post = session.post('https://talar.sfb833.uni-tuebingen.de/erdora/login', 
-                data = {"username": self.username, "password": self.password})
-            self.session = session
+    # records: iterable of OAI records, e.g. OAIHarvester.records() or iter_records(OAI.xml)
+    def validate_oai(self, records):
+        self.acl_dict = {}
+        self.login()
 
-    def _session_duration(self):
-        now = datetime.now()
-        diff = now - self.session_start
-        if diff.total_seconds()/3600 >= 1:
-            self.session_start = datetime.now()
-            self.login()
+        # at most 2 tasks per worker are queued, so the harvest doesn't run ahead too far
+        tasks = ((cmdi, res_handle, cmdi_handle) for cmdi in records
+            for cmdi_handle, res_handle in self._resources(cmdi))
+        bounded_map(self._check_resource, tasks, self.workers, strict=True)
+        return self.acl_dict
 
-    # sometimes the connection to TALAR is suddenly lost
-    # try connecting to an URL at least 3 times
-    def connect_to_URL(self, url):
-        for i in range(3):
+    # yields (cmdi_handle, res_handle) of every resource of the record
+    def _resources(self, cmdi):
+        # get the correct component namespace; (calling next(ite)) is not working for some reason
+        header = cmdi.find(".//{http://www.clarin.eu/cmd/1}Components")
+        c = 0
+        for i in header.iter():
+            if c == 1: break
+            c += 1
+        comp_ns = i.tag.split('}')[0][1:]
+
+        cmdi_handle = cmdi.find(".//*{http://www.clarin.eu/cmd/1}MdSelfLink").text.strip()
+        # print(cmdi_handle)
+        
+        resources_tmp = cmdi.findall(".//*{http://www.clarin.eu/cmd/1}ResourceProxy")
+        resources = [ resource for resource in resources_tmp if resource.find("./{http://www.clarin.eu/cmd/1}ResourceType").text == 'Resource']
+        res_proxy_list_info = cmdi.find(".//{"+comp_ns+"}ResourceProxyListInfo")            
+        
+        for res_proxy in resources:
+            if res_proxy_list_info is None:
+                continue
+            res_handle = res_proxy.find("{http://www.clarin.eu/cmd/1}ResourceRef").text.strip()
+            yield cmdi_handle, res_handle
+
+    def _check_resource(self, cmdi, res_handle, cmdi_handle):
+        self._session_duration()
+        if self.handles is not None:
+            redirect_url = self.handles.resolve(res_handle, self.session)
+        else:
             try:
-                r = self.session.get(url)
-                assert(r.status_code != 404)
-                return r
+                redirect_url = self.session.head(res_handle, allow_redirects=True).url
             except Exception:
-                #print("URL failure")
-                self.login()
-                continue
-        print(f"{url};404")
-        self.add_error(f"{url};404", url)
-
-
-    def add_error(self, error, cmdi):
-        if self.errors.get(cmdi) is None:
-            self.errors[cmdi] = []
-        self.errors[cmdi].append(error)
-
+                redirect_url = None
 
-    def validate_oai(self, xml):
-        self.acl_dict = {}
-        self.login()
-        
-        tree = ET.parse(xml)
-        root = tree.getroot()
-        all_cmdis = root.findall(".//{http://www.openarchives.org/OAI/2.0/}record")
+        if redirect_url is None:
+            print(f"{res_handle};too many redirects")
+            self.add_error(f"{res_handle};too many redirects", res_handle)
+            return
         
-        for cmdi in all_cmdis:
-            # get the correct component namespace; (calling next(ite)) is not working for some reason
-            header = cmdi.find(".//{http://www.clarin.eu/cmd/1}Components")
-            c = 0
-            for i in header.iter():
-                if c == 1: break
-                c += 1
-            comp_ns = i.tag.split('}')[0][1:]
-
-            cmdi_handle = cmdi.find(".//*{http://www.clarin.eu/cmd/1}MdSelfLink").text.strip()
-            # print(cmdi_handle)
-            
-            resources_tmp = cmdi.findall(".//*{http://www.clarin.eu/cmd/1}ResourceProxy")
-            resources = [ resource for resource in resources_tmp if resource.find("./{http://www.clarin.eu/cmd/1}ResourceType").text == 'Resource']
-            res_proxy_list_info = cmdi.find(".//{"+comp_ns+"}ResourceProxyListInfo")            
-            
-            for res_proxy in resources:
-                if res_proxy_list_info is None:
-                    continue
-                res_handle = res_proxy.find("{http://www.clarin.eu/cmd/1}ResourceRef").text.strip()
-                try:
-                    redirect_url = requests.head(res_handle, allow_redirects=True)
-                except Exception:
-                    print(f"{res_handle};too many redirects")
-                    self.add_error(f"{res_handle};too many redirects", res_handle)
-                    continue 
-                
-                # print(redirect_url.url)
-                self.acl_dict[res_handle] = self._validate_acl(cmdi, redirect_url.url, res_handle, cmdi_handle)
-            #break
-        return self.acl_dict
-                
+        # print(redirect_url)
+        acl = self._validate_acl(cmdi, redirect_url, res_handle, cmdi_handle)
+        with self._lock:
+            self.acl_dict[res_handle] = acl
 
 
     def _validate_acl(self, cmdi, res_url, res_handle, cmdi_handle):
@@ -151,11 +131,12 @@ def dump_acl(acl_dict, file="output/acl_dict.json"):
         if not os.path.exists(dir):
             os.makedirs(dir)
 
+    # the workers finish in any order, sorted keys keep the files comparable between runs
     with open(file, 'w', encoding="utf-8") as out_f:
-        json.dump(acl_dict, out_f)
+        json.dump(acl_dict, out_f, sort_keys=True)
         
     with open(f"{path}/acl_dict_{datetime.today().strftime('%Y-%m-%d')}.json", 'w', encoding="utf-8") as out_f:
-        json.dump(acl_dict, out_f)
+        json.dump(acl_dict, out_f, sort_keys=True)
         
         
 def load_acl(file):
@@ -166,10 +147,14 @@ def load_acl(file):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create Statistics HTML Talar/Evaluate existing CMDIs')
+    parser.add_argument("-i", "--input", help="OAI.xml (if not defined, records get harvested from TALAR)")
     parser.add_argument("-o", "--output", help="Output ACL JSON")
     parser.add_argument("-a", "--acl", help="Old ACL JSON")
     parser.add_argument("-u", "--user", help="Talar username")
     parser.add_argument("-p", "--password", help="Talar password")
+    parser.add_argument("-s", "--store", help="Record store; only records changed since the last run get checked")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of ACLs retrieved concurrently")
+    parser.add_argument("--handle-cache", help="Handle cache; resolved handles are not resolved again")
     args = parser.parse_args()
 
     if args.user is None or args.password is None:
@@ -179,15 +164,37 @@ if __name__ == '__main__':
         username = args.user
         password = args.password
 
-    req = requests.get("https://talar.sfb833.uni-tuebingen.de/erdora/rest/oai?verb=ListRecords&metadataPrefix=cmdi")
-    with open('oai_tmp.xml', 'wb') as f:
-        f.write(req.content)
+    harvester = OAIHarvester()
+    store = None
+    if args.store is not None:
+        store = RecordStore(args.store, keys=["acl"])
+
+    if args.input is not None:
+        records = iter_records(args.input, deleted=store is not None)
+    elif store is not None:
+        records = harvester.records(from_date=store.last_harvest, deleted=True)
+    else:
+        records = harvester.records()
+
+    if store is not None:
+        records = store.changed(records)
+
+    handles = None
+    if args.handle_cache is not None:
+        handles = HandleCache(args.handle_cache)
+
+    e = OAIEval(username=username, password=password, workers=args.workers, handles=handles)
+    acl_dict = e.validate_oai(records)
+    if handles is not None:
+        handles.save()
 
-    e = OAIEval(username=username, password=password)
-    acl_dict = e.validate_oai("oai_tmp.xml")
+    # resources of unchanged CMDIs keep the ACL of their last check
+    if store is not None:
+        print(f"{len(store.updated)} CMDIs checked, {len(store.deleted)} deleted")
+        acl_dict = store.merge("acl", acl_dict, by_resource=True)
+        store.save(last_harvest=harvester.response_date)
     
     if args.acl is not None:
         old_acl = load_acl(args.acl)
         compare_acls(acl_dict, old_acl)
-    dump_acl(acl_dict, file=args.output)
-    os.remove("oai_tmp.xml")
\ No newline at end of file
+    dump_acl(acl_dict, file=args.output)
\ No newline at end of file
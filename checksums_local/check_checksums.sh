@@ -1,5 +1,6 @@
 #!/bin/bash
 echo "Target Dir: $1"
 echo "Output Dir: $2"
-wget -O OAI.xml "https://talar.sfb833.uni-tuebingen.de/erdora/rest/oai?verb=ListRecords&metadataPrefix=cmdi"
-python2 check_checksums_local2.py -i OAI.xml -d "$1" -o "$2"
\ No newline at end of file
+# harvest all pages (resumptionTokens) of ListRecords into a single file
+python3 "$(dirname "$0")/../oai_harvester.py" -o OAI.xml
+python3 check_checksums_local2.py -i OAI.xml -d "$1" -o "$2" "${@:3}"
\ No newline at end of file
@@ -1,103 +1,320 @@
 import argparse
+import hashlib
+import mmap
 import os
-from collections import OrderedDict
+import sys
+from collections import deque
+from multiprocessing import Pool, cpu_count
 import xml.etree.ElementTree as ET
-import codecs
+from digest_index import DigestIndex
 
-def check_checksums(root_dir, checksum_dict):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fs_scan import scan
+
+# files of at least MMAP_SIZE bytes are mapped into memory, smaller ones are read in
+# chunks of BUFFER_SIZE bytes
+MMAP_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# directories/files matching one of these globs are skipped
+EXCLUDE = ("*trash*",)
+
+def check_checksums(root_dir, checksum_dict, exclude=EXCLUDE):
     visited_resources = set()
     not_in_cmdi = []
     affected_cmdis = []
     
-    for dir in os.walk(root_dir):
-        cur_dir = dir[0]
-        if "trash" in cur_dir:
-            continue
-        
-        files = dir[2]
-        full_path = os.path.abspath(cur_dir)
+    for path, file_stat in scan(root_dir, exclude=exclude):
+        full_path, file = os.path.split(path)
         
-        for file in files:
-            if str(file) in checksum_dict:
-                if file in visited_resources:
-                    not_in_cmdi.append(file + ";" + full_path + ";sha1sum exists twice or more on server")
-                    #print(f"{file};{full_path};sha1sum exists twice or more")
-                visited_resources.add(str(file))
-            else:
-                not_in_cmdi.append(file + ";" + full_path + ";not in any CMDI")
-                #print(f"File: {file} in DIR: {full_path} not in any CMDI")
+        if file in checksum_dict:
+            # the index is case-insensitive and iterates lowercase hex
+            sha1_sum = _unpack(_pack(file))
+            if sha1_sum in visited_resources:
+                not_in_cmdi.append(f"{file};{full_path};sha1sum exists twice or more on server")
+            visited_resources.add(sha1_sum)
+        else:
+            not_in_cmdi.append(f"{file};{full_path};not in any CMDI")
                 
-    for sha1_sum, res_handle in checksum_dict.items():
+    for sha1_sum in checksum_dict:
         if sha1_sum not in visited_resources:
-            affected_cmdis.append(res_handle + ";" + sha1_sum + ";missing or faulty")
-            #print(f"{res_handle};{sha1_sum};missing or faulty")
+            for res_handle in checksum_dict.handles(sha1_sum):
+                affected_cmdis.append(f"{res_handle};{sha1_sum};missing or faulty")
                 
     return not_in_cmdi, affected_cmdis
-                
-            
-def collect_checksums(xml):
-    checksum_dict = OrderedDict() # form {resource_handle: sha1_sum}
-    ns = {'ns1': 'http://www.clarin.eu/cmd/1',
-          'ns4': 'http://www.openarchives.org/OAI/2.0/'}
-    
-    tree = ET.parse(xml)
-    root = tree.getroot()
-    all_cmdis = root.findall(".//{"+ns['ns4']+"}record")
-    
-    for cmdi in all_cmdis:
-        # get the correct component namespace; (calling next(ite)) is not working for some reason
-        header = cmdi.find(".//{http://www.clarin.eu/cmd/1}Components")
-        c = 0
-        for i in header.iter():
-            if c == 1: break
-            c += 1
-        comp_ns = i.tag.split('}')[0][1:]
-
-        cmdi_handle = cmdi.find(".//*{http://www.clarin.eu/cmd/1}MdSelfLink").text.strip()
-        print(cmdi_handle)
-        
-        resources_tmp = cmdi.findall(".//*{http://www.clarin.eu/cmd/1}ResourceProxy")
-        resources = [ resource for resource in resources_tmp if resource.find("./{http://www.clarin.eu/cmd/1}ResourceType").text == 'Resource']
-        res_proxy_list_info = cmdi.find(".//{"+comp_ns+"}ResourceProxyListInfo")            
-        
-        for res_proxy in resources:
-            if res_proxy_list_info is None:
+
+
+# hashes the content of every file with a pool of processes and compares it to the
+# checksums of the CMDIs (files are named by their sha1 checksum on TALAR);
+# with a DigestIndex only new or modified files are hashed
+def verify_contents(root_dir, checksum_dict, processes=None, index=None, exclude=EXCLUDE):
+    visited_resources = set()
+    not_in_cmdi = []
+    affected_cmdis = []
+    corrupted = []
+
+    with Pool(processes or cpu_count()) as pool:
+        for path, digests in _digests(root_dir, pool, index, exclude):
+            full_path, file = os.path.split(path)
+            if digests is None:
+                corrupted.append(f"{file};{full_path};;can't be read")
                 continue
-            res_handle = res_proxy.find("{http://www.clarin.eu/cmd/1}ResourceRef").text.strip()
-            res_id = res_proxy.attrib["id"]
-            resource = res_proxy_list_info.find("{"+comp_ns+"}ResourceProxyInfo[@{http://www.clarin.eu/cmd/1}ref='"+res_id+"']")
-            
-            if resource is not None:
-                sha1_sum = _cmdi_checksums(resource, "sha1", comp_ns)
-                if sha1_sum is not None and len(sha1_sum) > 1:
-                    checksum_dict[sha1_sum] = res_handle
-                    
+
+            sha1_sum = digests["sha1"]
+            if file in checksum_dict and file.lower() != sha1_sum:
+                corrupted.append(f"{file};{full_path};{checksum_dict.handle(file)};sha1 mismatch, computed: {sha1_sum}")
+                # reported as corrupted, not again as missing
+                visited_resources.add(_unpack(_pack(file)))
+                continue
+            if sha1_sum not in checksum_dict:
+                not_in_cmdi.append(f"{file};{full_path};not in any CMDI")
+                continue
+
+            cmdi_digests = checksum_dict.digests(sha1_sum)
+            for algorithm in ("md5", "sha256"):
+                if cmdi_digests[algorithm] is not None and cmdi_digests[algorithm] != digests[algorithm]:
+                    corrupted.append(f"{file};{full_path};{checksum_dict.handle(sha1_sum)};"
+                        f"{algorithm} mismatch, CMDI: {cmdi_digests[algorithm]}, computed: {digests[algorithm]}")
+
+            if sha1_sum in visited_resources:
+                not_in_cmdi.append(f"{file};{full_path};sha1sum exists twice or more on server")
+            visited_resources.add(sha1_sum)
+
+    for sha1_sum in checksum_dict:
+        if sha1_sum not in visited_resources:
+            for res_handle in checksum_dict.handles(sha1_sum):
+                affected_cmdis.append(f"{res_handle};{sha1_sum};missing or faulty")
+
+    return not_in_cmdi, affected_cmdis, corrupted
+
+
+# yields (path, checksums) of every file, unchanged files are taken from the index;
+# the walk is consumed by the pool while it runs, so hashing starts with the first file
+def _digests(root_dir, pool, index, exclude):
+    indexed = deque()
+
+    # (path, stat) of the files to hash; runs in the task thread of the pool
+    def unindexed():
+        for path, file_stat in scan(root_dir, exclude=exclude):
+            digests = None
+            if index is not None:
+                digests = index.get(path, file_stat)
+            if digests is None:
+                yield path, file_stat
+            else:
+                indexed.append((path, digests))
+
+    for path, file_stat, digests in pool.imap_unordered(_hash_entry, unindexed(), chunksize=16):
+        while indexed:
+            yield indexed.popleft()
+        if index is not None and digests is not None:
+            index.put(path, file_stat, digests)
+        yield path, digests
+    while indexed:
+        yield indexed.popleft()
+
+
+# hash_file for a (path, stat) pair of the walk, returns (path, stat, checksums)
+def _hash_entry(entry):
+    path, file_stat = entry
+    return path, file_stat, hash_file(path)[1]
+
+
+# returns (path, {"md5": ..., "sha1": ..., "sha256": ...}), all checksums are computed in one read
+def hash_file(path):
+    hashes = {"md5": hashlib.md5(), "sha1": hashlib.sha1(), "sha256": hashlib.sha256()}
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= MMAP_SIZE:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    # every window is fed to all hashers while it is in the page cache,
+                    # so the file is read from disk only once
+                    with memoryview(m) as view:
+                        for i in range(0, len(view), BUFFER_SIZE):
+                            window = view[i:i + BUFFER_SIZE]
+                            for file_hash in hashes.values():
+                                file_hash.update(window)
+                            window.release()
+                finally:
+                    m.close()
+            else:
+                chunk = f.read(BUFFER_SIZE)
+                while chunk:
+                    for file_hash in hashes.values():
+                        file_hash.update(chunk)
+                    chunk = f.read(BUFFER_SIZE)
+    except (OSError, ValueError):
+        return path, None
+    return path, {algorithm: file_hash.hexdigest() for algorithm, file_hash in hashes.items()}
+
+
+OAI_NS = "http://www.openarchives.org/OAI/2.0/"
+CMD_NS = "http://www.clarin.eu/cmd/1"
+
+
+# sha1 -> resource handle index of all CMDIs; checksums are stored as raw bytes and handles
+# without their common prefix, so the index stays small for the whole repository.
+# A sha1 used by several resources keeps all of their handles.
+class ChecksumIndex:
+
+    def __init__(self, prefix="http://hdl.handle.net/"):
+        self.prefix = prefix
+        self._handles = {}
+        self._digests = {}
+
+    def add(self, sha1_sum, res_handle, md5=None, sha256=None):
+        key = _pack(sha1_sum)
+        if res_handle.startswith(self.prefix):
+            res_handle = res_handle[len(self.prefix):]
+
+        handles = self._handles.get(key)
+        if handles is None:
+            self._handles[key] = res_handle
+        elif isinstance(handles, tuple):
+            if res_handle not in handles:
+                self._handles[key] = handles + (res_handle,)
+        elif handles != res_handle:
+            self._handles[key] = (handles, res_handle)
+
+        if md5 is not None or sha256 is not None:
+            self._digests[key] = (_pack(md5), _pack(sha256))
+
+    def __contains__(self, sha1_sum):
+        return _pack(sha1_sum) in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+    # yields every sha1 (hex)
+    def __iter__(self):
+        for key in self._handles:
+            yield _unpack(key)
+
+    # returns all resource handles of the sha1
+    def handles(self, sha1_sum):
+        handles = self._handles[_pack(sha1_sum)]
+        if not isinstance(handles, tuple):
+            handles = (handles,)
+        # handles not starting with the prefix are stored as they are
+        return [res_handle if "://" in res_handle else self.prefix + res_handle for res_handle in handles]
+
+    def handle(self, sha1_sum):
+        return ",".join(self.handles(sha1_sum))
+
+    # returns {"md5": ..., "sha256": ...} of the sha1 as given in the CMDI
+    def digests(self, sha1_sum):
+        md5, sha256 = self._digests.get(_pack(sha1_sum), (None, None))
+        return {"md5": _unpack(md5), "sha256": _unpack(sha256)}
+
+    # returns {sha1: [handles]} of every sha1 used by more than one resource
+    def duplicates(self):
+        return {_unpack(key): self.handles(_unpack(key)) for key, handles in self._handles.items()
+                if isinstance(handles, tuple)}
+
+
+def _pack(checksum):
+    if checksum is None:
+        return None
+    try:
+        return bytes.fromhex(checksum)
+    except ValueError:
+        return checksum
+
+
+def _unpack(checksum):
+    if isinstance(checksum, bytes):
+        return checksum.hex()
+    return checksum
+
+
+# builds the ChecksumIndex while streaming through the OAI file, every record is
+# cleared as soon as it is processed; digests: keep md5/sha256 as well
+def collect_checksums(xml, digests=False):
+    checksum_dict = ChecksumIndex()
+    list_records = None
+
+    for event, elem in ET.iterparse(xml, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "{" + OAI_NS + "}ListRecords":
+                list_records = elem
+            continue
+        if elem.tag != "{" + OAI_NS + "}record":
+            continue
+
+        _collect_record(elem, checksum_dict, digests)
+        elem.clear()
+        if list_records is not None:
+            list_records.clear()
+
+    print(f"{len(checksum_dict)} checksums, {len(checksum_dict.duplicates())} used by several resources")
     return checksum_dict
 
+
+def _collect_record(cmdi, checksum_dict, digests):
+    components = cmdi.find(".//{" + CMD_NS + "}Components")
+    if components is None or len(components) == 0:
+        return
+    # the component namespace is the namespace of the profile
+    comp_ns = components[0].tag.split('}')[0][1:]
+
+    resources_tmp = cmdi.findall(".//{" + CMD_NS + "}ResourceProxy")
+    resources = [resource for resource in resources_tmp if resource.findtext("{" + CMD_NS + "}ResourceType") == 'Resource']
+    res_proxy_list_info = cmdi.find(".//{" + comp_ns + "}ResourceProxyListInfo")
+    if res_proxy_list_info is None:
+        return
+
+    infos = {}
+    for resource in res_proxy_list_info.iterfind("{" + comp_ns + "}ResourceProxyInfo"):
+        infos.setdefault(resource.get("{" + CMD_NS + "}ref"), resource)
+
+    for res_proxy in resources:
+        res_handle = res_proxy.findtext("{" + CMD_NS + "}ResourceRef").strip()
+        resource = infos.get(res_proxy.get("id"))
+
+        if resource is not None:
+            sha1_sum = _cmdi_checksums(resource, "sha1", comp_ns)
+            if sha1_sum is not None and len(sha1_sum) > 1:
+                if digests:
+                    checksum_dict.add(sha1_sum, res_handle,
+                        md5=_cmdi_checksums(resource, "md5", comp_ns) or None,
+                        sha256=_cmdi_checksums(resource, "sha256", comp_ns) or None)
+                else:
+                    checksum_dict.add(sha1_sum, res_handle)
+
         
 def _cmdi_checksums(resource, value, comp_ns):
-        checksum = resource.find(".//{"+comp_ns+"}" + value)
-        if checksum is not None:
-            try:
-                return checksum.text.strip()
-            except AttributeError:
-                return None
-        return None       
+    checksum = resource.find(".//{" + comp_ns + "}" + value)
+    if checksum is not None and checksum.text is not None:
+        return checksum.text.strip()
+    return None
 
 
-def write_to_csv(not_in_cmdi, affected_cmdis, output_dir="output/"):
+def write_to_csv(not_in_cmdi, affected_cmdis, output_dir="output/", corrupted=None, duplicates=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
                 
-    with codecs.open(output_dir+"not_in_cmdi.csv", 'w', 'utf-8') as f:
+    with open(output_dir+"not_in_cmdi.csv", 'w', encoding='utf-8') as f:
         f.write("File;Directory;Error\n")
         for element in not_in_cmdi:
             f.write(element + "\n")
             
-    with codecs.open(output_dir+"affected_cmdis.csv", 'w', 'utf-8') as f:
+    with open(output_dir+"affected_cmdis.csv", 'w', encoding='utf-8') as f:
         f.write("ResourceHandle;Sha1;Error\n")
         for element in affected_cmdis:
             f.write(element + "\n")
+
+    if duplicates is not None:
+        with open(output_dir+"duplicate_checksums.csv", 'w', encoding='utf-8') as f:
+            f.write("Sha1;ResourceHandles\n")
+            for sha1_sum, res_handles in duplicates.items():
+                f.write(f"{sha1_sum};{','.join(res_handles)}\n")
+
+    if corrupted is not None:
+        with open(output_dir+"corrupted_files.csv", 'w', encoding='utf-8') as f:
+            f.write("File;Directory;ResourceHandle;Error\n")
+            for element in corrupted:
+                f.write(element + "\n")
     
     
 if __name__ == '__main__':
@@ -105,12 +322,33 @@ if __name__ == '__main__':
     parser.add_argument("-i", "--input", help="Input OAI XML")
     parser.add_argument("-d", "--dir", help="Root directory")
     parser.add_argument("-o", "--output", help="Output directory")
+    parser.add_argument("-c", "--content", action="store_true", help="Hash the content of every file instead of only comparing file names")
+    parser.add_argument("-j", "--processes", type=int, help="Number of processes hashing files (default: number of CPUs)")
+    parser.add_argument("-x", "--index", help="Digest index (SQLite); only new or modified files get hashed again")
+    parser.add_argument("-e", "--exclude", action="append", help="Skip directories/files matching this glob (default: *trash*)")
     args = parser.parse_args()
     
     input_file = args.input
     root_dir = args.dir
     output = args.output
+    exclude = args.exclude or EXCLUDE
     
-    checksum_dict = collect_checksums(input_file)
-    not_in_cmdi, affected_cmdis = check_checksums(root_dir, checksum_dict)
-    write_to_csv(not_in_cmdi, affected_cmdis, output_dir=output)
\ No newline at end of file
+    checksum_dict = collect_checksums(input_file, digests=args.content)
+    duplicates = checksum_dict.duplicates()
+
+    if args.content:
+        index = None
+        if args.index is not None:
+            index = DigestIndex(args.index)
+        try:
+            not_in_cmdi, affected_cmdis, corrupted = verify_contents(root_dir, checksum_dict,
+                processes=args.processes, index=index, exclude=exclude)
+            if index is not None:
+                index.prune()
+        finally:
+            if index is not None:
+                index.close()
+        write_to_csv(not_in_cmdi, affected_cmdis, output_dir=output, corrupted=corrupted, duplicates=duplicates)
+    else:
+        not_in_cmdi, affected_cmdis = check_checksums(root_dir, checksum_dict, exclude=exclude)
+        write_to_csv(not_in_cmdi, affected_cmdis, output_dir=output, duplicates=duplicates)
\ No newline at end of file
@@ -0,0 +1,50 @@
+import sqlite3
+import threading
+
+
+# persistent index of the checksums of every file, a file is only hashed again
+# if its inode, size or mtime changed since the last run;
+# get() is called from the walk in the task thread of the pool, put() from the main thread
+class DigestIndex:
+
+    # commit_every: number of put() calls between commits, so an interrupted run keeps most of its work
+    def __init__(self, file="digest_index.sqlite", commit_every=1000):
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, "
+            "inode INTEGER, size INTEGER, mtime REAL, md5 TEXT, sha1 TEXT, sha256 TEXT)")
+        self.seen = set()
+        self.commit_every = commit_every
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    # returns the stored checksums if the file is unchanged, otherwise None
+    def get(self, path, stat):
+        with self._lock:
+            self.seen.add(path)
+            row = self.connection.execute("SELECT inode, size, mtime, md5, sha1, sha256 FROM digests WHERE path = ?",
+                (path,)).fetchone()
+        if row is None or tuple(row[:3]) != (stat.st_ino, stat.st_size, stat.st_mtime):
+            return None
+        return {"md5": row[3], "sha1": row[4], "sha256": row[5]}
+
+    def put(self, path, stat, digests):
+        with self._lock:
+            self.seen.add(path)
+            self.connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, stat.st_ino, stat.st_size, stat.st_mtime, digests["md5"], digests["sha1"], digests["sha256"]))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.connection.commit()
+                self.pending = 0
+
+    # removes all files that weren't seen in this run (deleted or moved)
+    def prune(self):
+        with self._lock:
+            paths = [row[0] for row in self.connection.execute("SELECT path FROM digests")]
+            self.connection.executemany("DELETE FROM digests WHERE path = ?",
+                [(path,) for path in paths if path not in self.seen])
+
+    def close(self):
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,82 @@
+from lxml import etree
+
+
+CMD_NS = "http://www.clarin.eu/cmd/1"
+
+# XPath expressions are compiled once and reused for every record
+RESOURCE_REF = etree.XPath("./*[local-name()='ResourceRef']")
+MIMETYPE = etree.XPath("./*[local-name()='ResourceType']/@mimetype")
+INFO_VALUES = {value: etree.XPath(f".//*[local-name()='{value}']") for value in ("Size", "md5", "sha1", "sha256")}
+
+
+# parses an OAI record in a single walk over its elements and indexes
+# the ResourceProxyInfo of every ResourceProxy by its id
+class CMDIRecord:
+
+    def __init__(self, record):
+        self.record = record
+        self.handle = None
+        self.profile = None
+        # ResourceProxies of ResourceType 'Resource'
+        self.resources = []
+        self.persons = []
+        # "firstName lastName" of every Person with both names
+        self.person_names = []
+        self.infos = {}
+
+        for elem in record.iter(etree.Element):
+            name = etree.QName(elem).localname
+            if name == "MdSelfLink" and self.handle is None:
+                self.handle = elem.text.strip()
+            elif name == "Components" and self.profile is None and len(elem) > 0:
+                self.profile = etree.QName(elem[0]).localname
+            elif name == "ResourceProxy":
+                res_type = elem.find("{" + CMD_NS + "}ResourceType")
+                if res_type is not None and 'Resource' in (res_type.text or ""):
+                    self.resources.append(elem)
+            elif name == "ResourceProxyInfo":
+                self.infos.setdefault(elem.get("{" + CMD_NS + "}ref"), elem)
+            elif name == "Person":
+                self.persons.append(elem)
+                person = _person_name(elem)
+                if person is not None:
+                    self.person_names.append(person)
+
+    # returns the ResourceProxyInfo belonging to a ResourceProxy
+    def info(self, res_proxy):
+        return self.infos.get(res_proxy.get("id"))
+
+
+def resource_ref(res_proxy):
+    return RESOURCE_REF(res_proxy)[0].text.strip()
+
+
+def mimetype(res_proxy):
+    mimetype = MIMETYPE(res_proxy)
+    if len(mimetype) > 0:
+        return mimetype[0].strip()
+    return None
+
+
+# returns the value (Size, md5, sha1, sha256) of a ResourceProxyInfo
+def info_value(resource, value):
+    element = INFO_VALUES[value](resource)
+    if len(element) > 0:
+        try:
+            return element[0].text.strip()
+        except AttributeError:
+            return None
+    return None
+
+
+# looks only at the children of the Person, no XPath needed
+def _person_name(person):
+    names = {}
+    for child in person.iterchildren(etree.Element):
+        name = etree.QName(child).localname
+        if name in ("firstName", "lastName") and name not in names:
+            names[name] = child.text
+    try:
+        return f"{names['firstName'].strip()} {names['lastName'].strip()}"
+    except (KeyError, AttributeError):
+        return None
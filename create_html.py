@@ -1,85 +1,140 @@
 import argparse
 import os
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import requests
-import seaborn as sns
 
+from cmdi_record import CMDIRecord, info_value, mimetype, resource_ref
 from datetime import datetime
-from lxml import etree
+from oai_harvester import OAIHarvester, iter_records
+from stats_history import StatsHistory
+
+# matplotlib is only imported for the plots and pandas only for the resource table,
+# so the HTML statistics (and importing this module) don't pay for them
+
+# columns of the per-resource table
+COLUMNS = ["handle", "cmdi", "profile", "mimetype", "size"]
 
 class CreateStatistics :
 
-    # returns dict with all statistics from OAI.xml
-    def collect_stats(self, xml):
-        ns = {'ns1': 'http://www.clarin.eu/cmd/1'}
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
         self.cmdi_counter = 0
-        self.resource_counter = 0
-        self.total_size = 0
         self.profiles = {}
-        self.mimetypes = {}
         self.person_set = set()
-        tree = etree.parse(xml)
-
-        all_cmdis = tree.xpath("//*[local-name()='record']") 
-        self.cmdi_counter = len(all_cmdis)
-
-        for cmdi in all_cmdis:
-            profile = cmdi.xpath(".//*[local-name()='Components']/*[1]")[0].tag.split('}')[-1]
-            resources = cmdi.xpath(".//*[local-name()='ResourceProxy'][(contains(*[local-name()='ResourceType'],  'Resource'))]")
-            persons = cmdi.xpath(".//*[local-name()='Person']")
-            print(cmdi)
-            self.resource_counter += len(resources)
-            self.count_profiles(profile)            
-            self.get_person(persons)
-
-            for res_proxy in resources:
-                res_proxy_list = cmdi.xpath(".//*[local-name()='ResourceProxyInfo'][@ns1:ref='" + 
-                    res_proxy.attrib["id"] +"']", namespaces=ns)
-                
-                if len(res_proxy_list) > 0:
-                    resource = res_proxy_list[0]
-                    size = resource.xpath(".//*[local-name()='Size']")
-                    mimetype = res_proxy.xpath(".//*[local-name()='ResourceType']/@mimetype")
-                    
-                    if len(size) > 0:
-                        try:
-                            size = int(size[0].text.strip())
-                        except AttributeError:
-                            size = 0
-                    else:
-                        size = 0
-                    self.total_size += size
-
-                    if (len(mimetype) > 0):
-                        mimetype = mimetype[0].strip()
-                        self.add_mimetype(mimetype, size)
-            
+        self.columns = {column: [] for column in COLUMNS}
+        self.table = None
+
+    # returns dict with all statistics from the OAI records,
+    # e.g. OAIHarvester.records() or iter_records(OAI.xml);
+    # records are streamed, only the current one is held in memory
+    def collect_stats(self, records):
+        self.reset()
+        for cmdi in records:
+            self.add_record(cmdi)
+        return self.stats()
+
+    # adds a single OAI record to the statistics, the record is walked only once
+    # every resource becomes one row of the resource table
+    def add_record(self, cmdi):
+        record = CMDIRecord(cmdi)
+        self.cmdi_counter += 1
+        self.count_profiles(record.profile)            
+        self.person_set.update(record.person_names)
+
+        for res_proxy in record.resources:
+            resource = record.info(res_proxy)
+            # no ResourceProxyInfo: size is missing (NA), otherwise 0 if the Size is empty
+            size = None
+            if resource is not None:
+                size = int(info_value(resource, "Size") or 0)
+
+            self.columns["handle"].append(resource_ref(res_proxy))
+            self.columns["cmdi"].append(record.handle)
+            self.columns["profile"].append(record.profile)
+            self.columns["mimetype"].append(mimetype(res_proxy))
+            self.columns["size"].append(size)
+
+    def stats(self):
         return {"cmdi_count": self.cmdi_counter,
-                "resource_count": self.resource_counter,
+                "resource_count": len(self.columns["size"]),
                 "person_count": len(self.person_set),
                 "profiles": self.profiles,
-                "TotalSize": self.total_size,
-                "Mimetypes": self.mimetypes}
-
-
-    def add_mimetype(self, mimetype, size):
-        if self.mimetypes.get(mimetype) is None:
-            self.mimetypes[mimetype] = {"size": 0, "count": 0}
-        if size is not None:
-            self.mimetypes[mimetype]["size"] += size
-        self.mimetypes[mimetype]["count"] += 1
-
-    def get_person(self, persons):
-        for person in persons:
-            first_name = person.xpath("./*[local-name()='firstName']")
-            last_name = person.xpath("./*[local-name()='lastName']")
-            try:
-                name =  f"{first_name[0].text.strip()} {last_name[0].text.strip()}"
-                self.person_set.add(name)
-            except:
-                pass    
+                "TotalSize": self.total_size(),
+                "Mimetypes": self.mimetype_stats()}
+
+    def total_size(self):
+        return sum(size for size in self.columns["size"] if size is not None)
+
+    # returns {value: {"size": .., "count": ..}} of the resources per value of column
+    # (e.g. mimetype, profile or cmdi) sorted by count (or size), ties in order of appearance;
+    # only resources with a ResourceProxyInfo are counted. This is the only aggregation,
+    # the HTML, the plots and group_stats() use it, so it works without pandas
+    def column_stats(self, column="mimetype", sort="count"):
+        groups = {}
+        for value, size in zip(self.columns[column], self.columns["size"]):
+            if value is None or size is None:
+                continue
+            if groups.get(value) is None:
+                groups[value] = {"size": 0, "count": 0}
+            groups[value]["size"] += size
+            groups[value]["count"] += 1
+        return dict(sorted(groups.items(), key=lambda x: x[1][sort], reverse=True))
+
+    def mimetype_stats(self, sort="count"):
+        return self.column_stats("mimetype", sort)
+
+    # per-resource DataFrame with the COLUMNS, built on first use
+    def get_table(self):
+        if self.table is None:
+            import pandas as pd
+            self.set_table(pd.DataFrame(self.columns, columns=COLUMNS))
+        return self.table
+
+    def set_table(self, table):
+        table["size"] = table["size"].astype("Int64")
+        for column in ("profile", "mimetype"):
+            table[column] = table[column].astype("category")
+        self.table = table
+
+    # column_stats() as a DataFrame (index: the values of column, columns: size, count)
+    def group_stats(self, column="profile", sort="count"):
+        import pandas as pd
+        grouped = pd.DataFrame.from_dict(self.column_stats(column, sort), orient="index", columns=["size", "count"])
+        return grouped.astype("int64").rename_axis(column)
+
+    # the n largest resources
+    def top_resources(self, n=10):
+        return self.get_table().nlargest(n, "size")
+
+    # size percentiles of all resources with a known size
+    def size_percentiles(self, percentiles=(0.5, 0.9, 0.99)):
+        return self.get_table()["size"].dropna().astype("int64").quantile(list(percentiles))
+
+    # saves the resource table as Parquet or Feather (by file extension),
+    # so new reports don't need to parse the OAI records again
+    def save_table(self, file="output/resources.parquet"):
+        dir = os.path.dirname(file)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        if file.endswith(".feather"):
+            self.get_table().reset_index(drop=True).to_feather(file)
+        else:
+            self.get_table().to_parquet(file, index=False)
+
+    # loads a saved resource table for the table based reports (mimetype_stats, total_size,
+    # group_stats, top_resources, size_percentiles); the CMDI count, profiles and persons are
+    # not in the table, they are cleared, so stats() and create_statistics() need collect_stats()
+    def load_table(self, file="output/resources.parquet"):
+        import pandas as pd
+        self.reset()
+        if file.endswith(".feather"):
+            self.set_table(pd.read_feather(file))
+        else:
+            self.set_table(pd.read_parquet(file))
+        # missing values become None again, like in collect_stats()
+        self.columns = {column: self.table[column].astype(object).where(self.table[column].notna(), None).tolist()
+            for column in COLUMNS}
+        return self.table
 
     def count_profiles(self, profile):
         if self.profiles.get(profile) is None:
@@ -97,11 +152,7 @@ class CreateStatistics :
 
     def create_mimetype_list(self, mimetypes):
         html_list = "\n"
-        sorted_mimetypes = sorted(mimetypes.keys(), key=lambda x: mimetypes[x]["count"], reverse=True)
-        #print("____________________")
-        #print(sorted_mimetypes)
-        for mimetype in sorted_mimetypes:
-            v = mimetypes[mimetype]
+        for mimetype, v in mimetypes.items():
             count = v["count"]
             t = "MB"
             mime_size = round(v["size"] / 1024 / 1024, 3)
@@ -124,7 +175,7 @@ class CreateStatistics :
     <table>
       <tr>
         <td>Number of files hosted</td>
-        <td>{self.resource_counter}</td>
+        <td>{len(self.columns["size"])}</td>
       </tr>
       <tr>
         <td>Number of digital objects</td>
@@ -143,12 +194,12 @@ class CreateStatistics :
       </tr>
       <tr>
         <td>Total size</td>
-        <td>{round(self.total_size / 1024 / 1024 /1024, 3)} (GB)</td>
+        <td>{round(self.total_size() / 1024 / 1024 /1024, 3)} (GB)</td>
       </tr>
       <tr>
         <td>Mimetypes</td>
         <td>
-          <ul>{self.create_mimetype_list(self.mimetypes)}
+          <ul>{self.create_mimetype_list(self.mimetype_stats())}
           </ul>             
         </td>
       </tr>
@@ -159,40 +210,23 @@ class CreateStatistics :
   """
         return html_table
     
-    def create_histogram(self, dir="output"):
-        sorted_mimetypes_names = sorted(self.mimetypes.keys(), key=lambda x: self.mimetypes[x]["count"], reverse=True)
-        sorted_mimetypes_names2 = sorted(self.mimetypes.keys(), key=lambda x: self.mimetypes[x]["size"], reverse=True)
-        sorted_mimetypes_count = [self.mimetypes[k]["count"] for k in sorted_mimetypes_names]
-        sorted_mimetypes_size = [self.mimetypes[k]["size"] for k in sorted_mimetypes_names2]
-        #print(sorted_mimetypes_count)
-        #exit()
-        
-        mime_names = [ x.split('/')[-1].split('.')[-1] for x in sorted_mimetypes_names ]
-        mime_count = [x for x in sorted_mimetypes_count]
-        mime_size = [int(round(x / 1024 / 1024, 4)) for x in sorted_mimetypes_size]
-
-
-        plt.bar(mime_names, mime_count)
-        plt.ylabel('Count')
-        plt.xlabel('Mimetype')
-        plt.yticks(range(0, int(max(mime_count)+1.0), 500))
-        plt.xticks(rotation=45, ha="right")
-        fig = plt.gcf()
-        fig.set_size_inches(18.5, 10.5)
-        #plt.show()
-        #plt.tight_layout()
-        plt.savefig(dir + "/count_plot.png", dpi=100)
-        
-        plt.clf()
+    # renders the count and size plots per mimetype in one batch (headless, see plotting.py),
+    # formats: e.g. ("png", "svg"), log: log-scale y axis; returns the written files
+    def create_histogram(self, dir="output", formats=("png",), log=False, dpi=100):
+        from plotting import bar_figure, save_figures
+
+        # same aggregates (and order) as the mimetype list of the HTML
+        by_count = self.mimetype_stats(sort="count")
+        by_size = self.mimetype_stats(sort="size")
         
-        plt.bar(mime_names, mime_size)
-        plt.ylabel('Size (MB)')
-        plt.xlabel('Mimetype')
-        plt.yticks(range(0, max(mime_size)+1, 7500))
-        plt.xticks(rotation=45, ha="right")
-        fig = plt.gcf()
-        fig.set_size_inches(18.5, 10.5)
-        plt.savefig(dir + "/size_plot.png")
+        mime_names = [ x.split('/')[-1].split('.')[-1] for x in by_count ]
+        mime_names_size = [ x.split('/')[-1].split('.')[-1] for x in by_size ]
+        mime_count = [ x["count"] for x in by_count.values() ]
+        mime_size = [ round(x["size"] / 1024 / 1024, 4) for x in by_size.values() ]
+
+        figures = {"count_plot": bar_figure(mime_names, mime_count, 'Mimetype', 'Count', log),
+                   "size_plot": bar_figure(mime_names_size, mime_size, 'Mimetype', 'Size (MB)', log)}
+        return save_figures(figures, dir, formats, dpi)
 
 
     def write_to_file(self, html_code, file="output/statistics.html"):
@@ -207,19 +241,40 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create Statistics HTML Talar existing CMDIs')
     parser.add_argument("-i", "--input", help="OAI.xml")
     parser.add_argument("-o", "--output", help="Output Statistics HTML/plots directory")
+    parser.add_argument("-t", "--table", help="Save the per-resource table (.parquet or .feather)")
+    parser.add_argument("--history", help="Append the statistics to this snapshot store (e.g. output/stats_history.jsonl) and create the trend report")
+    parser.add_argument("--date", help="Date of the snapshot (YYYY-MM-DD), e.g. of an old OAI.xml. Default: today")
+    parser.add_argument("--trend-only", action="store_true", help="Only create the trend report/plot from --history, no records are read")
+    parser.add_argument("--no-plots", action="store_true", help="Only create the HTML, no plots (matplotlib is not loaded)")
+    parser.add_argument("--plot-format", nargs='+', default=["png"], help="Formats of the plots, e.g. png svg. Default: png")
+    parser.add_argument("--log", action="store_true", help="Log-scale y axis for the plots")
     args = parser.parse_args()
+    if args.trend_only and args.history is None:
+        parser.error("--trend-only needs --history")
+    if args.history is not None:
+        history = StatsHistory(args.history)
+        if args.trend_only:
+            CreateStatistics().write_to_file(history.create_trend_report(), os.path.join(args.output, "trend.html"))
+            if not args.no_plots:
+                history.create_trend_plots(args.output, formats=args.plot_format, log=args.log)
+            exit()
+
     e = CreateStatistics()
     if args.input is None:
-        req = requests.get("https://talar.sfb833.uni-tuebingen.de/erdora/rest/oai?verb=ListRecords&metadataPrefix=cmdi")
-        with open('oai_tmp.xml', 'wb') as f:
-            f.write(req.content)
-        stats = e.collect_stats("oai_tmp.xml")
+        records = OAIHarvester().records()
+    else:
+        records = iter_records(args.input)
     
-    stats = e.collect_stats(args.input)
+    stats = e.collect_stats(records)
+    if args.table is not None:
+        e.save_table(args.table)
+    if args.history is not None:
+        history.append(stats, args.date)
+        e.write_to_file(history.create_trend_report(), os.path.join(args.output, "trend.html"))
+        if not args.no_plots:
+            history.create_trend_plots(args.output, formats=args.plot_format, log=args.log)
     html_code = e.create_statistics(stats)
     print(html_code)
-    e.create_histogram(args.output)
-    e.write_to_file((args.output + "statistics.html"))
-    
-    if args.input is None:
-        os.remove("oai_tmp.xml")
+    if not args.no_plots:
+        e.create_histogram(args.output, args.plot_format, args.log)
+    e.write_to_file(html_code, os.path.join(args.output, "statistics.html"))
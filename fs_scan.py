@@ -0,0 +1,70 @@
+import fnmatch
+import os
+import threading
+
+from queue import Queue
+
+
+_DONE = object()
+
+
+# walks the directory tree with several threads (one os.scandir call per directory)
+# and yields (path, stat) of every file (symlinks to files included) as soon as it is found;
+# like os.walk, symlinked directories are not descended into;
+# directories and files matching one of the exclude globs (name or full path) are skipped,
+# excluded directories are not descended into
+def scan(root_dir, exclude=(), threads=8):
+    dirs = Queue()
+    files = Queue(maxsize=10000)
+    state = {"pending": 1}
+    lock = threading.Lock()
+
+    def excluded(entry):
+        for pattern in exclude:
+            if fnmatch.fnmatch(entry.name, pattern) or fnmatch.fnmatch(entry.path, pattern):
+                return True
+        return False
+
+    def worker():
+        while True:
+            cur_dir = dirs.get()
+            if cur_dir is _DONE:
+                return
+            try:
+                for entry in os.scandir(cur_dir):
+                    if excluded(entry):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            with lock:
+                                state["pending"] += 1
+                            dirs.put(entry.path)
+                        elif entry.is_file():
+                            # symlinked files are reported with the stat of their target
+                            files.put((entry.path, entry.stat()))
+                        elif entry.is_symlink() and not entry.is_dir():
+                            # broken symlink, reported like os.walk does (it can't be read)
+                            files.put((entry.path, entry.stat(follow_symlinks=False)))
+                    except OSError:
+                        continue
+            except OSError:
+                pass
+
+            # the last directory is done, stop the consumer and all workers
+            with lock:
+                state["pending"] -= 1
+                finished = state["pending"] == 0
+            if finished:
+                files.put(_DONE)
+                for i in range(threads):
+                    dirs.put(_DONE)
+
+    dirs.put(os.path.abspath(root_dir))
+    for i in range(threads):
+        threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        item = files.get()
+        if item is _DONE:
+            return
+        yield item
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+
+from datetime import datetime, timedelta
+
+
+# persistent handle -> resolved URL cache shared by all tools; failed resolutions
+# are cached as well (for a shorter time), so broken handles are not retried on every run
+class HandleCache:
+
+    def __init__(self, file="output/handle_cache.json", ttl=7, negative_ttl=1):
+        self.file = file
+        # days a resolved URL is valid resp. hours a failed resolution is remembered
+        self.ttl = timedelta(days=ttl)
+        self.negative_ttl = timedelta(hours=negative_ttl)
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as in_f:
+                self.entries = json.load(in_f)
+
+    # returns the cached entry ({"url": ..., "error": ...}) or None if there is none or it expired
+    def get(self, handle):
+        with self._lock:
+            entry = self.entries.get(handle)
+        if entry is None:
+            return None
+
+        ttl = self.ttl if entry["error"] is None else self.negative_ttl
+        if datetime.now() - datetime.fromisoformat(entry["resolved"]) > ttl:
+            return None
+        return entry
+
+    # returns the cached URL of the handle if it is still valid
+    def url(self, handle):
+        entry = self.get(handle)
+        if entry is None:
+            return None
+        return entry["url"]
+
+    def put(self, handle, url):
+        with self._lock:
+            self.entries[handle] = {"url": url, "error": None, "resolved": datetime.now().isoformat()}
+
+    def put_error(self, handle, error):
+        with self._lock:
+            self.entries[handle] = {"url": None, "error": error, "resolved": datetime.now().isoformat()}
+
+    def remove(self, handle):
+        with self._lock:
+            self.entries.pop(handle, None)
+
+    # resolves the handle (following all redirects) unless it is cached,
+    # returns the URL or None if the handle can't be resolved
+    def resolve(self, handle, session):
+        entry = self.get(handle)
+        if entry is not None:
+            return entry["url"]
+
+        try:
+            r = session.head(handle, allow_redirects=True)
+        except Exception as e:
+            self.put_error(handle, repr(e))
+            return None
+
+        if r.status_code >= 400:
+            self.put_error(handle, r.status_code)
+            return None
+        self.put(handle, r.url)
+        return r.url
+
+    # expired entries are not written back
+    def save(self):
+        with self._lock:
+            entries = dict(self.entries)
+        entries = {k: v for k, v in entries.items() if self.get(k) is not None}
+
+        dir = os.path.dirname(self.file)
+        if dir != "" and not os.path.exists(dir):
+            os.makedirs(dir)
+
+        with open(self.file + ".tmp", 'w', encoding="utf-8") as out_f:
+            json.dump(entries, out_f)
+        os.replace(self.file + ".tmp", self.file)
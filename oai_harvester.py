@@ -0,0 +1,132 @@
+import argparse
+import requests
+import tempfile
+
+from lxml import etree
+
+
+OAI_URL = "https://talar.sfb833.uni-tuebingen.de/erdora/rest/oai"
+OAI_NS = "http://www.openarchives.org/OAI/2.0/"
+
+RECORD = "{" + OAI_NS + "}record"
+TOKEN = "{" + OAI_NS + "}resumptionToken"
+RESPONSE_DATE = "{" + OAI_NS + "}responseDate"
+ERROR = "{" + OAI_NS + "}error"
+
+# pages up to SPOOL_SIZE bytes are buffered in memory, larger ones in a temporary file
+SPOOL_SIZE = 32 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class OAIHarvesterError(Exception):
+    pass
+
+
+class OAIHarvester:
+
+    # retries: number of times a page is requested before the harvest fails
+    def __init__(self, url=OAI_URL, metadata_prefix="cmdi", session=None, retries=3):
+        self.url = url
+        self.retries = max(1, retries)
+        self.metadata_prefix = metadata_prefix
+        self.session = session if session is not None else requests.Session()
+        # responseDate of the first page, can be used as "from" for the next harvest
+        self.response_date = None
+
+    # yields every record of ListRecords one at a time and follows the resumptionTokens;
+    # every page is downloaded completely before its records are yielded, so a slow consumer
+    # doesn't keep the response open (and cut by a server timeout), records are parsed one at a time
+    def records(self, from_date=None, until=None, deleted=False):
+        params = {"verb": "ListRecords", "metadataPrefix": self.metadata_prefix}
+        if from_date is not None:
+            params["from"] = from_date
+        if until is not None:
+            params["until"] = until
+
+        while params is not None:
+            token = None
+            with self._fetch_page(params) as page:
+                for elem in _iterparse(page):
+                    if elem.tag == RECORD:
+                        if deleted or not is_deleted(elem):
+                            yield elem
+                    elif elem.tag == TOKEN:
+                        token = (elem.text or "").strip()
+                    elif elem.tag == RESPONSE_DATE:
+                        if self.response_date is None:
+                            self.response_date = elem.text.strip()
+                    elif elem.tag == ERROR:
+                        # no records since from_date is not an error
+                        if elem.get("code") == "noRecordsMatch":
+                            return
+                        raise OAIHarvesterError(f"{elem.get('code')};{(elem.text or '').strip()}")
+
+            # an empty resumptionToken marks the last page
+            if token:
+                params = {"verb": "ListRecords", "resumptionToken": token}
+            else:
+                params = None
+
+    # returns the page of params as a spooled temporary file;
+    # a failed page is requested again with the same params (resumptionToken)
+    def _fetch_page(self, params):
+        for i in range(self.retries):
+            page = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            try:
+                with self.session.get(self.url, params=params, stream=True) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        page.write(chunk)
+                page.seek(0)
+                return page
+            except requests.RequestException as e:
+                page.close()
+                error = e
+                print(f"OAI page failure: {e!r}")
+        raise OAIHarvesterError(f"{params};{error!r}")
+
+
+# yields every record of a local OAI file one at a time
+def iter_records(xml, deleted=False):
+    for elem in _iterparse(xml):
+        if elem.tag == RECORD and (deleted or not is_deleted(elem)):
+            yield elem
+
+
+# records are detached from the document once they are parsed, so only the record
+# currently being processed is kept in memory
+def _iterparse(source):
+    context = etree.iterparse(source, events=("end",), tag=(RECORD, TOKEN, RESPONSE_DATE, ERROR),
+        remove_blank_text=True, huge_tree=True)
+    for event, elem in context:
+        if elem.tag == RECORD:
+            elem.getparent().remove(elem)
+        yield elem
+
+
+def is_deleted(record):
+    header = record.find("{" + OAI_NS + "}header")
+    return header is not None and header.get("status") == "deleted"
+
+
+# writes all records of a harvest into a single ListRecords document
+def dump_records(records, file="OAI.xml"):
+    with open(file, "wb") as out_f:
+        out_f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_f.write(f'<OAI-PMH xmlns="{OAI_NS}">\n<ListRecords>\n'.encode("utf-8"))
+        for record in records:
+            out_f.write(etree.tostring(record, encoding="utf-8"))
+            out_f.write(b"\n")
+        out_f.write(b"</ListRecords>\n</OAI-PMH>\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Harvest all records of the TALAR OAI-PMH endpoint into one file')
+    parser.add_argument("-o", "--output", default="OAI.xml", help="Output OAI XML")
+    parser.add_argument("-u", "--url", default=OAI_URL, help="OAI-PMH endpoint")
+    parser.add_argument("--from", dest="from_date", help="Only harvest records changed since this date")
+    parser.add_argument("--until", help="Only harvest records changed until this date")
+    args = parser.parse_args()
+
+    h = OAIHarvester(url=args.url)
+    dump_records(h.records(from_date=args.from_date, until=args.until), file=args.output)
@@ -0,0 +1,330 @@
+import argparse
+import copy
+import getpass
+import os
+import sys
+import threading
+
+from queue import Queue
+from oai_harvester import OAIHarvester, iter_records
+from record_store import RecordStore
+
+
+# harvests (or reads) the OAI records once and streams every record through several stages;
+# network stages (availability, checksums, ACL) run at the same time in their own thread
+# with their own copy of each record, cheap stages (statistics, authority IDs) run inline
+
+_DONE = object()
+
+STAGES = ("availability", "checksums", "acl", "statistics", "ids")
+
+
+class Stage:
+    name = None
+    # True: run() gets an iterator of records in its own thread, False: add() is called per record
+    concurrent = False
+    # key of the results in the RecordStore, None if the stage doesn't use the store
+    store_key = None
+    by_resource = False
+
+    def __init__(self):
+        # results of run(), e.g. the errors
+        self.result = {}
+        # True if run() or add() raised, the stage is then neither merged nor finished
+        self.failed = False
+
+    def add(self, record):
+        pass
+
+    def run(self, records):
+        pass
+
+    # writes the report, result: result of the stage (merged with the store)
+    def finish(self, result):
+        pass
+
+
+class AvailabilityStage(Stage):
+    name = "availability"
+    concurrent = True
+    store_key = "availability_errors"
+
+    def __init__(self, check, report, output="output/availability_log.txt"):
+        super().__init__()
+        self.check = check
+        # OAIEval of repo_eval.py, used for the error log format
+        self.report = report
+        self.output = output
+
+    def run(self, records):
+        self.result = self.check.validate_oai(records)
+
+    def finish(self, result):
+        self.report.errors = result
+        self.report.dump_error_log(file=self.output)
+
+
+class ChecksumStage(Stage):
+    name = "checksums"
+    concurrent = True
+    store_key = "errors"
+
+    def __init__(self, evaluation, output="output/error_log.txt"):
+        super().__init__()
+        self.evaluation = evaluation
+        self.output = output
+
+    def run(self, records):
+        self.result = self.evaluation.validate_oai(records)
+
+    def finish(self, result):
+        self.evaluation.errors = result
+        self.evaluation.dump_error_log(file=self.output)
+
+
+class ACLStage(Stage):
+    name = "acl"
+    concurrent = True
+    store_key = "acl"
+    by_resource = True
+
+    def __init__(self, evaluation, output="output/acl_dict.json", old_acl=None):
+        super().__init__()
+        self.evaluation = evaluation
+        self.output = output
+        self.old_acl = old_acl
+
+    def run(self, records):
+        self.result = self.evaluation.validate_oai(records)
+
+    def finish(self, result):
+        from check_acl import compare_acls, dump_acl, load_acl
+        if self.old_acl is not None:
+            compare_acls(result, load_acl(self.old_acl))
+        dump_acl(result, file=self.output)
+
+
+class StatisticsStage(Stage):
+    name = "statistics"
+
+    def __init__(self, statistics, output_dir="output", plots=True, history=None):
+        super().__init__()
+        self.statistics = statistics
+        self.output_dir = output_dir
+        self.plots = plots
+        # optional StatsHistory
+        self.history = history
+        self.statistics.reset()
+
+    def add(self, record):
+        self.statistics.add_record(record)
+
+    def finish(self, result):
+        stats = self.statistics.stats()
+        self.statistics.write_to_file(self.statistics.create_statistics(stats),
+            os.path.join(self.output_dir, "statistics.html"))
+        if self.history is not None:
+            self.history.append(stats)
+            self.statistics.write_to_file(self.history.create_trend_report(),
+                os.path.join(self.output_dir, "trend.html"))
+        if self.plots:
+            self.statistics.create_histogram(self.output_dir)
+            if self.history is not None:
+                self.history.create_trend_plots(self.output_dir)
+
+
+class AuthorityIDStage(Stage):
+    name = "ids"
+
+    # cache: backend of update_cmdi_with_IDs/cache_store.py
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def add(self, record):
+        from cmdi_extractor import cmdi_to_cache
+        partial = {}
+        cmdi_to_cache(record, partial)
+        self.cache.update(partial)
+
+    def finish(self, result):
+        self.cache.save()
+        print(f"{len(self.cache)} names in the authority ID cache")
+
+
+class Pipeline:
+
+    # queue_size: number of records a concurrent stage may lag behind the harvest
+    def __init__(self, stages, queue_size=100, store=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.store = store
+
+    # returns the failed stages
+    def run(self, records):
+        queues = []
+        threads = []
+        for stage in self.stages:
+            if stage.concurrent:
+                q = Queue(maxsize=self.queue_size)
+                thread = threading.Thread(target=self._run_stage, args=(stage, q), daemon=True)
+                thread.start()
+                queues.append(q)
+                threads.append(thread)
+
+        count = 0
+        for record in records:
+            count += 1
+            # each thread gets its own copy, lxml trees are not shared between threads
+            for q in queues:
+                q.put(copy.deepcopy(record))
+            for stage in self.stages:
+                if not stage.concurrent and not stage.failed:
+                    self._add(stage, record)
+        for q in queues:
+            q.put(_DONE)
+        for thread in threads:
+            thread.join()
+        print(f"{count} records processed")
+
+        failed = [stage for stage in self.stages if stage.failed]
+        for stage in self.stages:
+            if stage.failed:
+                continue
+            result = stage.result
+            # unchanged CMDIs keep the results of their last check
+            if self.store is not None and stage.store_key is not None:
+                result = self.store.merge(stage.store_key, result, by_resource=stage.by_resource)
+            stage.finish(result)
+        return failed
+
+    def _add(self, stage, record):
+        try:
+            stage.add(record)
+        except Exception as e:
+            stage.failed = True
+            print(f"Stage failure: {stage.name}: {e!r}")
+
+    def _run_stage(self, stage, q):
+        try:
+            stage.run(_queued(q))
+        except Exception as e:
+            stage.failed = True
+            print(f"Stage failure: {stage.name}: {e!r}")
+            # keep consuming, so the harvest is not blocked by a failed stage
+            for record in _queued(q):
+                pass
+
+
+def _queued(q):
+    while True:
+        record = q.get()
+        if record is _DONE:
+            return
+        yield record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Harvest TALAR once and run several checks on every record')
+    parser.add_argument("stages", nargs='*', default=["checksums", "acl", "statistics"],
+                        help=f"Stages to run: {', '.join(STAGES)} (default: checksums acl statistics)")
+    parser.add_argument("-i", "--input", help="OAI.xml (if not defined, records get harvested from TALAR)")
+    parser.add_argument("-o", "--output", default="output", help="Output directory of all reports")
+    parser.add_argument("-u", "--user", help="Talar username")
+    parser.add_argument("-p", "--password", help="Talar password")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of resources checked concurrently per stage")
+    parser.add_argument("--per-host", type=int, help="Max. number of parallel connections per host (default: 4, availability: 100)")
+    parser.add_argument("--concurrency", type=int, default=200, help="Number of concurrent availability checks")
+    parser.add_argument("-s", "--store", help="Record store; only records changed since the last run get checked")
+    parser.add_argument("-c", "--cache", help="Verification cache of the checksum stage")
+    parser.add_argument("--handle-cache", help="Handle cache of the checksum and ACL stages")
+    parser.add_argument("-a", "--acl", help="Old ACL JSON to compare the ACLs with")
+    parser.add_argument("--history", help="Statistics snapshot store (see create_html.py)")
+    parser.add_argument("--no-plots", action="store_true", help="No statistics plots")
+    parser.add_argument("--id-cache", default="update_cmdi_with_IDs/cache.json",
+                        help="Authority ID cache of the ids stage (.json or .sqlite)")
+    args = parser.parse_args()
+
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name}, choose from {', '.join(STAGES)}")
+    # only changed records are harvested with a store, the statistics would be incomplete
+    if args.store is not None and "statistics" in args.stages:
+        parser.error("the statistics stage needs all records, it can't be used with --store")
+
+    username = password = None
+    if {"availability", "checksums", "acl"} & set(args.stages):
+        if args.user is None or args.password is None:
+            username = input("Username: ")
+            password = getpass.getpass("Password: ")
+        else:
+            username = args.user
+            password = args.password
+
+    harvester = OAIHarvester()
+    store = None
+    if args.store is not None:
+        # every stage keeps its own harvest date and checked records in the store
+        classes = (AvailabilityStage, ChecksumStage, ACLStage, AuthorityIDStage)
+        store = RecordStore(args.store, keys=[cls.store_key or cls.name for cls in classes if cls.name in args.stages])
+
+    if args.input is not None:
+        records = iter_records(args.input, deleted=store is not None)
+    elif store is not None:
+        records = harvester.records(from_date=store.last_harvest, deleted=True)
+    else:
+        records = harvester.records()
+
+    if store is not None:
+        records = store.changed(records)
+
+    handles = cache = None
+    if args.handle_cache is not None:
+        from handle_cache import HandleCache
+        handles = HandleCache(args.handle_cache)
+
+    stages = []
+    if "availability" in args.stages or "checksums" in args.stages:
+        from repo_eval import OAIEval
+    if "availability" in args.stages:
+        from availability import AvailabilityCheck
+        check = AvailabilityCheck(username=username, password=password, concurrency=args.concurrency,
+                                  per_host=args.per_host or 100)
+        stages.append(AvailabilityStage(check, OAIEval(username=username, password=password),
+                                        os.path.join(args.output, "availability_log.txt")))
+    if "checksums" in args.stages:
+        if args.cache is not None:
+            from verification_cache import VerificationCache
+            cache = VerificationCache(args.cache)
+        evaluation = OAIEval(username=username, password=password, workers=args.workers,
+                             per_host=args.per_host or 4, cache=cache, handles=handles)
+        stages.append(ChecksumStage(evaluation, os.path.join(args.output, "error_log.txt")))
+    if "acl" in args.stages:
+        import check_acl
+        evaluation = check_acl.OAIEval(username=username, password=password, workers=args.workers, handles=handles)
+        stages.append(ACLStage(evaluation, os.path.join(args.output, "acl_dict.json"), args.acl))
+    if "statistics" in args.stages:
+        from create_html import CreateStatistics
+        history = None
+        if args.history is not None:
+            from stats_history import StatsHistory
+            history = StatsHistory(args.history)
+        stages.append(StatisticsStage(CreateStatistics(), args.output, plots=not args.no_plots, history=history))
+    if "ids" in args.stages:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_cmdi_with_IDs"))
+        from cache_store import open_cache
+        stages.append(AuthorityIDStage(open_cache(args.id_cache)))
+
+    failed = Pipeline(stages, store=store).run(records)
+
+    if cache is not None:
+        cache.save()
+    if handles is not None:
+        handles.save()
+    if failed:
+        # the store is not saved, so the next run checks the same records again
+        print(f"Failed stages: {', '.join(stage.name for stage in failed)}")
+        sys.exit(1)
+    if store is not None:
+        print(f"{len(store.updated)} CMDIs checked, {len(store.deleted)} deleted")
+        store.save(last_harvest=harvester.response_date)
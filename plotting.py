@@ -0,0 +1,51 @@
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+
+
+# headless plotting with the object-oriented matplotlib API: figures are created without
+# pyplot (no global figure state, no GUI backend), so it is safe to render in worker processes
+
+def new_figure(rows=1, size=(18.5, 10.5), sharex=False):
+    fig = Figure(figsize=size)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows, 1, sharex=sharex)
+    return fig, axes
+
+
+# sets a log scale or a bounded number of integer ticks, instead of one tick per fixed step
+def scale_axis(ax, log=False):
+    if log:
+        ax.set_yscale("log")
+    else:
+        ax.yaxis.set_major_locator(MaxNLocator(nbins=12, integer=True))
+
+
+def bar_figure(names, values, xlabel, ylabel, log=False):
+    fig, ax = new_figure()
+    ax.bar(names, values)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    scale_axis(ax, log)
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment("right")
+    fig.tight_layout()
+    return fig
+
+
+# renders all figures ({name: Figure}) in one batch as dir/name.<format> (png, svg, ...)
+# and returns the written files
+def save_figures(figures, dir="output", formats=("png",), dpi=100):
+    if not os.path.exists(dir):
+        os.makedirs(dir, exist_ok=True)
+
+    files = []
+    for name, fig in figures.items():
+        for format in formats:
+            file = os.path.join(dir, f"{name}.{format}")
+            fig.savefig(file, format=format, dpi=dpi)
+            files.append(file)
+    return files
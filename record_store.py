@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+
+from lxml import etree
+from oai_harvester import OAI_NS, is_deleted
+
+
+CMD_NS = "http://www.clarin.eu/cmd/1"
+
+
+# fields of a record entry, all other fields are results stored by merge()
+FIELDS = ("identifier", "datestamp", "hash", "deleted", "resources", "checked")
+
+
+# local copy of the harvested records (keyed by MdSelfLink) with their datestamp
+# and content hash, used to only process records that changed since the last run;
+# several scripts can share a store, the harvest date and the hash a record was last
+# checked with are kept per key (e.g. "errors" of repo_eval.py, "acl" of check_acl.py)
+class RecordStore:
+
+    # keys: keys of the checks of this run
+    def __init__(self, file="output/record_store.json", keys=("errors",)):
+        self.file = file
+        self.keys = list(keys)
+        self.records = {}
+        # key -> date of the last harvest checked for that key
+        self.harvests = {}
+        # handles that were new/changed resp. deleted in the current run
+        self.updated = []
+        self.deleted = []
+
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as in_f:
+                tmp = json.load(in_f)
+            self.records = tmp["records"]
+            if "harvests" in tmp:
+                self.harvests = tmp["harvests"]
+            else:
+                self._upgrade(tmp["last_harvest"])
+        self.identifiers = {v["identifier"]: k for k, v in self.records.items()}
+
+    # stores without per key state: every stored result was checked at the last harvest
+    def _upgrade(self, last_harvest):
+        for entry in self.records.values():
+            entry["checked"] = {key: entry["hash"] for key in entry if key not in FIELDS}
+            if last_harvest is not None:
+                for key in entry["checked"]:
+                    self.harvests[key] = last_harvest
+
+    # OAI from date of this run: the oldest harvest of its keys, None if a key was never checked
+    @property
+    def last_harvest(self):
+        dates = [self.harvests.get(key) for key in self.keys]
+        if not dates or None in dates:
+            return None
+        return min(dates)
+
+    # yields only records that are new or changed since one of the keys last checked them,
+    # deleted records are marked in the store;
+    # records should be harvested with deleted=True, so deletions can be tracked
+    def changed(self, records):
+        for record in records:
+            header = record.find("{" + OAI_NS + "}header")
+            identifier = header.findtext("{" + OAI_NS + "}identifier", default="").strip()
+            datestamp = header.findtext("{" + OAI_NS + "}datestamp", default="").strip()
+
+            if is_deleted(record):
+                self._delete(identifier, datestamp)
+                continue
+
+            cmdi_handle = record.findtext(".//{" + CMD_NS + "}MdSelfLink").strip()
+            metadata = record.find("{" + OAI_NS + "}metadata")
+            content_hash = hashlib.sha1(etree.tostring(metadata, method="c14n")).hexdigest()
+
+            entry = self.records.get(cmdi_handle)
+            if entry is None or entry["deleted"]:
+                entry = self.records[cmdi_handle] = {"checked": {}}
+            elif all(entry["checked"].get(key) == content_hash for key in self.keys):
+                entry["hash"] = content_hash
+                entry["datestamp"] = datestamp
+                continue
+
+            # results of other keys are kept until these are checked again
+            resources = [res.text.strip() for res in record.iterfind(".//{" + CMD_NS + "}ResourceRef")
+                if res.text is not None]
+            entry.update({"identifier": identifier, "datestamp": datestamp,
+                "hash": content_hash, "deleted": False, "resources": resources})
+            self.identifiers[identifier] = cmdi_handle
+            self.updated.append(cmdi_handle)
+            yield record
+
+    def _delete(self, identifier, datestamp):
+        cmdi_handle = self.identifiers.get(identifier)
+        if cmdi_handle is None or self.records[cmdi_handle]["deleted"]:
+            return
+        self.records[cmdi_handle] = {"identifier": identifier, "datestamp": datestamp,
+            "hash": None, "deleted": True, "resources": [], "checked": {}}
+        self.deleted.append(cmdi_handle)
+        print(f"{cmdi_handle};deleted")
+
+    # stores the results of the updated records under key and returns the results of
+    # all records in the store, so unchanged records keep the results of their last check;
+    # results are keyed by CMDI handle or, if by_resource is set, by resource handle
+    def merge(self, key, results, by_resource=False):
+        merged_keys = set()
+        for cmdi_handle in self.updated:
+            entry = self.records[cmdi_handle]
+            if by_resource:
+                entry[key] = {res: results[res] for res in entry["resources"] if res in results}
+                merged_keys.update(entry[key])
+            else:
+                entry[key] = self._record_results(cmdi_handle, entry, results)
+                merged_keys.update(self._result_keys(cmdi_handle, entry))
+
+        # results that belong to no checked record are kept under their own key, not dropped
+        unknown = {k: v for k, v in results.items() if k not in merged_keys}
+        for k in unknown:
+            print(f"{k};{key} of no checked record")
+
+        merged = {}
+        for cmdi_handle, entry in self.records.items():
+            if entry["deleted"] or entry.get(key) is None:
+                continue
+            if by_resource:
+                merged.update(entry[key])
+            else:
+                merged[cmdi_handle] = entry[key]
+        merged.update(unknown)
+        return merged
+
+    # keys the results of a record can have: the CMDI handle, or a resource handle
+    # (with and without its @ part, see TalarSession.add_error) for errors of a resource
+    def _result_keys(self, cmdi_handle, entry):
+        keys = [cmdi_handle]
+        for res in entry["resources"]:
+            for res_key in (res, res.split('@')[0]):
+                if res_key not in keys:
+                    keys.append(res_key)
+        return keys
+
+    # all errors of a record, including those keyed by one of its resources; None if there are none
+    def _record_results(self, cmdi_handle, entry, results):
+        errors = []
+        for res_key in self._result_keys(cmdi_handle, entry):
+            errors.extend(results.get(res_key) or [])
+        return errors or None
+
+    # marks the updated records as checked for the keys of this run; only call it
+    # if all checks of the run succeeded
+    def save(self, last_harvest=None):
+        for cmdi_handle in self.updated:
+            for key in self.keys:
+                self.records[cmdi_handle]["checked"][key] = self.records[cmdi_handle]["hash"]
+        if last_harvest is not None:
+            for key in self.keys:
+                self.harvests[key] = last_harvest
+
+        dir = os.path.dirname(self.file)
+        if dir != "" and not os.path.exists(dir):
+            os.makedirs(dir)
+
+        # write to a temporary file first, so an aborted run can't corrupt the store
+        with open(self.file + ".tmp", 'w', encoding="utf-8") as out_f:
+            json.dump({"harvests": self.harvests, "records": self.records}, out_f)
+        os.replace(self.file + ".tmp", self.file)
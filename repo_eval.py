@@ -1,77 +1,154 @@
 import argparse
 import hashlib
 import getpass
+import itertools
 import json
 from json.decoder import JSONDecodeError
 import os
-import requests
+import threading
 #import urllib3
 
-from datetime import datetime
-from lxml import etree
+from bounded_pool import BoundedExecutor
+from cmdi_record import CMDIRecord, info_value, resource_ref
+from handle_cache import HandleCache
+from oai_harvester import OAIHarvester, iter_records
+from record_store import RecordStore
+from talar_session import TalarSession
+from verification_cache import VerificationCache
+from urllib.parse import urlparse
 #from create_html import write_to_file, create_statistics
 
-
-
-class OAIEval:
-
-    def __init__(self, username, password, acl_restricted='acl_restricted.txt'):
-        self.username = username
-        self.password = password 
-        self.session_start = datetime.now()
-        self.errors = {}
+# chunk size for resources that are streamed through the hashers
+CHUNK_SIZE = 1024 * 1024
+
+
+class OAIEval(TalarSession):
+
+    def __init__(self, username, password, acl_restricted='acl_restricted.txt', workers=1, per_host=4, download_dir=None, cache=None, handles=None, small_size=1024 * 1024):
+        # workers: number of resources that are verified at the same time
+        super().__init__(username, password, workers)
+        # max. number of open connections to a single host
+        self.per_host = max(1, per_host)
+        self._host_slots = {}
+        # resources are only written to disk if a download directory is given
+        self.download_dir = download_dir
+        # optional VerificationCache, unchanged resources are not downloaded again
+        self.cache = cache
+        # optional HandleCache, resources are requested from their resolved URL directly
+        self.handles = handles
+        # resources up to small_size bytes (CMDI Size) are read at once into a buffer
+        # that every worker thread reuses, larger ones are streamed in CHUNK_SIZE chunks
+        self.small_size = small_size
+        self._buffers = threading.local()
 
         with open(acl_restricted, 'r', encoding='utf-8') as in_f:
             self.acl_restricted = in_f.read().splitlines()
 
-    def login(self):
-        with requests.Session() as session:
-            post = session.post('https://talar.sfb833.uni-tuebingen.de/erdora/login', 
-                data = {"username": self.username, "password": self.password})
-            self.session = session
-
-    def _session_duration(self):
-        now = datetime.now()
-        diff = now - self.session_start
-        if diff.total_seconds()/3600 >= 1:
-            self.session_start = datetime.now()
-            self.login()
-
-    def _download_file(self, url):
-        with self.session.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open("tmp_file", "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    f.write(chunk)
-            return r.url
-
-    # sometimes the connection to TALAR is suddenly lost
-    # try connecting to an URL at least 3 times
-    def connect_to_URL(self, url, file=False):
-        for i in range(3):
-            try:
-                if file:
-                    return self._download_file(url)
+    # semaphore limiting the number of parallel connections to the host of url
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if self._host_slots.get(host) is None:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    # streamed GET, returns the response and the acquired slot of the host it comes from:
+    # the slot of the handle server is only held while the handle is resolved (redirects),
+    # the body is read in the slot of the resolved host
+    def _get(self, url, headers):
+        slot = self._host_slot(url)
+        slot.acquire()
+        try:
+            r = self.session.get(url, stream=True, headers=headers)
+        except Exception:
+            slot.release()
+            raise
+        resolved_slot = self._host_slot(r.url)
+        if resolved_slot is not slot:
+            slot.release()
+            resolved_slot.acquire()
+        return r, resolved_slot
+
+    # returns the cached error if the handle failed recently and there is no verified URL
+    # to ask instead; such handles are not requested again until the entry expires
+    def _failed_resolution(self, res_handle):
+        if self.handles is None or (self.cache is not None and self.cache.get(res_handle) is not None):
+            return None
+        entry = self.handles.get(res_handle)
+        if entry is None:
+            return None
+        return entry["error"]
+
+    # returns the resolved URL and size + checksums of the resource,
+    # size: Size of the resource in the CMDI (None if unknown)
+    def _download_file(self, url, size=None):
+        request_url = url
+        headers = {}
+        cached = None
+        resolved = None
+        if self.cache is not None:
+            cached = self.cache.get(url)
+        if self.handles is not None:
+            resolved = self.handles.url(url)
+
+        # ask the resolved URL directly whether the resource changed since the last check
+        if cached is not None:
+            request_url = cached["url"]
+            headers = self.cache.conditional_headers(cached)
+        elif resolved is not None:
+            request_url = resolved
+
+        r, slot = self._get(request_url, headers)
+        try:
+            with r:
+                if cached is not None and r.status_code == 304:
+                    return r.url, self.cache.hit(url)
+                if r.status_code >= 400 and request_url != url:
+                    # resolved URL is outdated, the next try resolves the handle again
+                    if self.cache is not None:
+                        self.cache.remove(url)
+                    if self.handles is not None:
+                        self.handles.remove(url)
+                elif r.status_code >= 400 and self.handles is not None:
+                    self.handles.put_error(url, r.status_code)
+                r.raise_for_status()
+
+                if size is not None and size <= self.small_size:
+                    chunks = self._read_small(r)
                 else:
-                    r = self.session.get(url) # CMDI.xml
-                    assert(r.status_code != 404)
-                    return r
-            except Exception:
-                print("URL failure")
-                self.login()
-                continue
-        self.add_error(f"{url};404", url)
-        print(f"{url};404")
-
-
-    def add_error(self, error, cmdi):
-        if '@' in cmdi:
-            cmdi_handle = cmdi.split('@')[0]
-        else:
-            cmdi_handle = cmdi
-        if self.errors.get(cmdi_handle) is None:
-            self.errors[cmdi_handle] = []
-        self.errors[cmdi_handle].append(error)
+                    chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+                if self.download_dir is None:
+                    calc_checksums = self._compute_checksums(chunks)
+                else:
+                    os.makedirs(self.download_dir, exist_ok=True)
+                    file = os.path.join(self.download_dir, url.split("hdl.handle.net/")[-1].replace("/", "_"))
+                    with open(file, "wb") as f:
+                        calc_checksums = self._compute_checksums(chunks, out_f=f)
+        finally:
+            slot.release()
+
+        if self.cache is not None:
+            self.cache.put(url, r.url, r.headers, calc_checksums)
+        if self.handles is not None:
+            self.handles.put(url, r.url)
+        return r.url, calc_checksums
+
+    # reads a small resource into the reusable buffer of the current thread and returns its
+    # content as memoryview, which is hashed in place; if the resource is larger than
+    # the buffer (wrong CMDI Size), the rest is streamed
+    def _read_small(self, r):
+        buffer = getattr(self._buffers, "buffer", None)
+        if buffer is None:
+            buffer = self._buffers.buffer = memoryview(bytearray(self.small_size + 1))
+
+        r.raw.decode_content = True
+        total = 0
+        while total < len(buffer):
+            n = r.raw.readinto(buffer[total:])
+            if not n:
+                return [buffer[:total]]
+            total += n
+        return itertools.chain([buffer[:total]], r.iter_content(chunk_size=CHUNK_SIZE))
 
     def add_mimetype(self, mimetype, size):
         if self.mimetypes.get(mimetype) is None:
@@ -83,60 +160,79 @@ class OAIEval:
         self.mimetypes[mimetype]["count"] += 1
 
 
-    def validate_oai(self, xml):
+    # records: iterable of OAI records, e.g. OAIHarvester.records() or iter_records(OAI.xml)
+    def validate_oai(self, records):
         self.cmdi_counter = 0
         self.resource_counter = 0
         self.profiles = {}
         self.person_set = set()
         self.errors = {}
-        tree = etree.parse(xml)
 
         self.login()
-        
-        all_cmdis = tree.xpath("//*[local-name()='record']")   
-
-        # retrieve every ns4:record
-        for cmdi in all_cmdis:
-            cmdi_handle = cmdi.xpath(".//*[local-name()='MdSelfLink']")[0].text.strip()
-            resources = cmdi.xpath(".//*[local-name()='ResourceProxy'][(contains(*[local-name()='ResourceType'],  'Resource'))]")
-            cmdi_page = self.connect_to_URL(cmdi_handle)
-            print(cmdi_handle)
-
-            if cmdi_page is None:
-                continue
-   
-            if cmdi_page.status_code == 404:
-                self.add_error(f"{cmdi_handle};404", cmdi_handle)
-                print(f"{cmdi_handle};404")
-
-            self._validate_resources(cmdi, cmdi_handle, resources)
+
+        # resources are verified by a pool of workers; at most 2 tasks per worker
+        # are queued so records are not held in memory longer than necessary
+        with BoundedExecutor(self.workers) as pool:
+            # retrieve every ns4:record; while the workers verify resources
+            # the next records are already harvested
+            for cmdi in records:
+                record = CMDIRecord(cmdi)
+
+                # the page check is queued before its resources, so a worker waiting
+                # for it never waits for a task that has not been started yet
+                cmdi_page = pool.submit(self._validate_cmdi_page, record.handle)
+                for res_proxy in record.resources:
+                    pool.submit(self._validate_resources, record.handle, res_proxy, record.info(res_proxy), cmdi_page)
+        # a record with a failed task is not completely verified
+        pool.raise_failures()
     
         print(f"Finished, {len(self.errors)} CMDI files affected")
         return self.errors
 
-    def _validate_resources(self, cmdi, cmdi_handle, resources):
-        ns = {'ns1': 'http://www.clarin.eu/cmd/1'}
-        for res_proxy in resources:
-            res_handle = res_proxy.xpath(".//*[local-name()='ResourceRef']")[0].text.strip()
-            res_proxy_list = cmdi.xpath(".//*[local-name()='ResourceProxyInfo'][@ns1:ref='" + 
-                res_proxy.attrib["id"] +"']", namespaces=ns)
-            print("    ", res_handle)
-
-            # Check if Resource is online
-            self._session_duration()
-            res_url = self.connect_to_URL(res_handle, file=True)
-            if res_url is None:
-                continue
-            
-            # Check ACL settings of resource - use check_acl.py; checking for Availabilty label is unreliable
-            # self._validate_acl(cmdi, res_url, res_handle, cmdi_handle)
-            
-            # Extract checksums
-            if len(res_proxy_list) > 0:
-                resource = res_proxy_list[0]
-                self._validate_checksum(resource, res_handle, cmdi_handle)
+    # returns True if the CMDI page is online
+    def _validate_cmdi_page(self, cmdi_handle):
+        cmdi_page = self.connect_to_URL(cmdi_handle)
+        print(cmdi_handle)
+
+        if cmdi_page is None:
+            return False
 
-            os.remove("tmp_file")
+        if cmdi_page.status_code == 404:
+            self.add_error(f"{cmdi_handle};404", cmdi_handle)
+            print(f"{cmdi_handle};404")
+        return True
+
+    # resource: ResourceProxyInfo of res_proxy (None if the CMDI has none)
+    def _validate_resources(self, cmdi_handle, res_proxy, resource, cmdi_page):
+        if not cmdi_page.result():
+            return
+
+        res_handle = resource_ref(res_proxy)
+        print("    ", res_handle)
+
+        # Check if Resource is online
+        self._session_duration()
+        size = None
+        if resource is not None:
+            size = self._cmdi_checksums(resource, "Size")
+        size = int(size) if size is not None and size.isdigit() else None
+        # no retries (and re-logins) for a cached failure
+        error = self._failed_resolution(res_handle)
+        if error is not None:
+            self.add_error(f"{res_handle};{error}", res_handle)
+            print(f"{res_handle};{error}")
+            return
+        download = self.connect_to_URL(res_handle, fetch=lambda url: self._download_file(url, size))
+        if download is None:
+            return
+        res_url, calc_checksums = download
+        
+        # Check ACL settings of resource - use check_acl.py; checking for Availabilty label is unreliable
+        # self._validate_acl(cmdi, res_url, res_handle, cmdi_handle)
+        
+        # Extract checksums
+        if resource is not None:
+            self._validate_checksum(resource, res_handle, cmdi_handle, calc_checksums)
 
     # use check_acl.py; checking for Availabilty label is unreliable
     """
@@ -172,7 +268,7 @@ class OAIEval:
         self.add_error(f"{res_handle};ACL incorrect", cmdi_handle)
         """
 
-    def _validate_checksum(self, resource, res_handle, handle):  
+    def _validate_checksum(self, resource, res_handle, handle, calc_checksums):  
         valid = True
         cmdi_checksums = {}        
         cmdi_checksums["size"] = self._cmdi_checksums(resource, "Size")
@@ -180,14 +276,6 @@ class OAIEval:
         cmdi_checksums["sha1"] = self._cmdi_checksums(resource, "sha1")
         cmdi_checksums["sha256"] = self._cmdi_checksums(resource, "sha256")
 
-        c_size = os.path.getsize("tmp_file")
-        calc_checksums = {
-            "size": c_size,
-            "md5": self._compute_checksum("md5"),
-            "sha1": self._compute_checksum("sha1"),
-            "sha256": self._compute_checksum("sha256")
-        }
-
         for k, v in cmdi_checksums.items():
             calc_v = calc_checksums[k]
 
@@ -199,24 +287,23 @@ class OAIEval:
 
 
     def _cmdi_checksums(self, resource, value):
-        checksum = resource.xpath(".//*[local-name()='" + value + "']")
-        if len(checksum) > 0:
-            try:
-                return checksum[0].text.strip()
-            except AttributeError:
-                return None
-        return None
-
-    def _compute_checksum(self, checksum):
-        with open("tmp_file", "rb") as f:
-            file_hash = hashlib.sha256()
-            if checksum == "md5":
-                file_hash = hashlib.md5()
-            elif checksum == "sha1":
-                file_hash = hashlib.sha1()     
-            while chunk := f.read(8192):
+        return info_value(resource, value)
+
+    # feeds every chunk into all hashers at once, so the resource is read only once
+    def _compute_checksums(self, chunks, out_f=None):
+        size = 0
+        hashes = {"md5": hashlib.md5(), "sha1": hashlib.sha1(), "sha256": hashlib.sha256()}
+        for chunk in chunks:
+            size += len(chunk)
+            for file_hash in hashes.values():
                 file_hash.update(chunk)
-        return file_hash.hexdigest()
+            if out_f is not None:
+                out_f.write(chunk)
+
+        calc_checksums = {"size": size}
+        for checksum, file_hash in hashes.items():
+            calc_checksums[checksum] = file_hash.hexdigest()
+        return calc_checksums
 
     
     def dump_error_log(self, file="output/error_log.txt"):
@@ -235,9 +322,23 @@ class OAIEval:
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create Statistics HTML Talar/Evaluate existing CMDIs')
+    parser.add_argument("-i", "--input", help="OAI.xml (if not defined, records get harvested from TALAR)")
     parser.add_argument("-o", "--output", help="Output error log")
     parser.add_argument("-u", "--user", help="Talar username")
     parser.add_argument("-p", "--password", help="Talar password")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of resources verified concurrently")
+    parser.add_argument("--per-host", type=int, help="Max. number of parallel connections per host (default: 4, availability check: 100)")
+    parser.add_argument("-a", "--availability-only", action="store_true",
+                        help="Only check if CMDIs/resources are online and compare their size, no checksums")
+    parser.add_argument("--concurrency", type=int, default=200, help="Number of concurrent availability checks")
+    parser.add_argument("-d", "--download-dir", help="Keep downloaded resources in this directory")
+    parser.add_argument("-s", "--store", help="Record store; only records changed since the last run get checked")
+    parser.add_argument("-c", "--cache", help="Verification cache; unchanged resources (HTTP 304) are not downloaded again")
+    parser.add_argument("--recheck-ratio", type=float, default=0.05, help="Share of cached resources that get verified anyway")
+    parser.add_argument("--max-age", type=int, default=30, help="Days after which a cached resource gets verified again")
+    parser.add_argument("--handle-cache", help="Handle cache; resources are requested from their resolved URL directly")
+    parser.add_argument("--small-size", type=int, default=1024 * 1024,
+                        help="Resources up to this size in bytes (CMDI Size) are read into memory at once (default: 1 MiB)")
     args = parser.parse_args()
 
     if args.user is None or args.password is None:
@@ -247,15 +348,51 @@ if __name__ == '__main__':
         username = args.user
         password = args.password
 
-    req = requests.get("https://talar.sfb833.uni-tuebingen.de/erdora/rest/oai?verb=ListRecords&metadataPrefix=cmdi")
-    with open('oai_tmp.xml', 'wb') as f:
-        f.write(req.content)
+    harvester = OAIHarvester()
+    store = None
+    if args.store is not None:
+        store = RecordStore(args.store, keys=["availability_errors" if args.availability_only else "errors"])
 
-    e = OAIEval(username=username, password=password)
-    errors = e.validate_oai("oai_tmp.xml")
+    if args.input is not None:
+        records = iter_records(args.input, deleted=store is not None)
+    elif store is not None:
+        records = harvester.records(from_date=store.last_harvest, deleted=True)
+    else:
+        records = harvester.records()
+
+    if store is not None:
+        records = store.changed(records)
+
+    cache = None
+    if args.cache is not None:
+        cache = VerificationCache(args.cache, recheck_ratio=args.recheck_ratio, max_age=args.max_age)
+
+    handles = None
+    if args.handle_cache is not None:
+        handles = HandleCache(args.handle_cache)
+
+    e = OAIEval(username=username, password=password, workers=args.workers, per_host=args.per_host or 4,
+                download_dir=args.download_dir, cache=cache, handles=handles, small_size=args.small_size)
+    if args.availability_only:
+        # aiohttp is only needed for -a
+        from availability import AvailabilityCheck
+        a = AvailabilityCheck(username=username, password=password, concurrency=args.concurrency,
+                              per_host=args.per_host or 100)
+        e.errors = errors = a.validate_oai(records)
+    else:
+        errors = e.validate_oai(records)
+    if cache is not None:
+        cache.save()
+    if handles is not None:
+        handles.save()
+
+    # unchanged CMDIs keep the errors of their last check
+    if store is not None:
+        print(f"{len(store.updated)} CMDIs checked, {len(store.deleted)} deleted")
+        key = "availability_errors" if args.availability_only else "errors"
+        e.errors = errors = store.merge(key, errors)
+        store.save(last_harvest=harvester.response_date)
     print(f"{len(errors)} CMDIs affected")
     
     if args.output is not None:
-        e.dump_error_log(file=args.output)
-
-    os.remove("oai_tmp.xml")
\ No newline at end of file
+        e.dump_error_log(file=args.output)
\ No newline at end of file
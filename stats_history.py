@@ -0,0 +1,113 @@
+import json
+import os
+
+from datetime import datetime
+
+
+# append-only store of the statistics of create_html.py, one JSON line per snapshot;
+# a later snapshot of the same date replaces the earlier one when reading
+class StatsHistory:
+
+    def __init__(self, file="output/stats_history.jsonl"):
+        self.file = file
+
+    # stats: dict from CreateStatistics.collect_stats(), date: YYYY-MM-DD (default: today)
+    def append(self, stats, date=None):
+        if date is None:
+            date = datetime.now().strftime("%Y-%m-%d")
+        dir = os.path.dirname(self.file)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+
+        with open(self.file, 'a', encoding='utf-8') as out_f:
+            out_f.write(json.dumps({"date": date, "stats": stats}) + "\n")
+
+    # returns [(date, stats), ...] sorted by date
+    def snapshots(self):
+        snapshots = {}
+        if not os.path.exists(self.file):
+            return []
+        with open(self.file, 'r', encoding='utf-8') as in_f:
+            for line in in_f:
+                if line.strip():
+                    snapshot = json.loads(line)
+                    snapshots[snapshot["date"]] = snapshot["stats"]
+        return sorted(snapshots.items())
+
+    # returns one row per snapshot with the totals and the growth since the previous snapshot
+    def trend(self):
+        rows = []
+        previous = None
+        for date, stats in self.snapshots():
+            row = {"date": date,
+                   "files": stats["resource_count"],
+                   "cmdis": stats["cmdi_count"],
+                   "size": stats["TotalSize"],
+                   "mimetypes": len(stats["Mimetypes"])}
+            if previous is None:
+                row["files_diff"] = 0
+                row["size_diff"] = 0
+                row["new_mimetypes"] = []
+            else:
+                row["files_diff"] = stats["resource_count"] - previous["resource_count"]
+                row["size_diff"] = stats["TotalSize"] - previous["TotalSize"]
+                row["new_mimetypes"] = sorted(set(stats["Mimetypes"]) - set(previous["Mimetypes"]))
+            rows.append(row)
+            previous = stats
+        return rows
+
+    # return HTML string with the growth over time
+    def create_trend_report(self):
+        html_rows = ""
+        for row in self.trend():
+            html_rows += f"""
+      <tr>
+        <td>{row["date"]}</td>
+        <td>{row["files"]} ({row["files_diff"]:+d})</td>
+        <td>{row["cmdis"]}</td>
+        <td>{round(row["size"] / 1024 / 1024 / 1024, 3)} ({round(row["size_diff"] / 1024 / 1024 / 1024, 3):+}) (GB)</td>
+        <td>{row["mimetypes"]}{" - new: " + ", ".join(row["new_mimetypes"]) if row["new_mimetypes"] else ""}</td>
+      </tr>"""
+
+        html_table = f"""
+  <!-- TABLE TREND START -->
+  <div class="post-content">
+    <table>
+      <tr>
+        <th>Date</th>
+        <th>Number of files hosted</th>
+        <th>Number of digital objects</th>
+        <th>Total size</th>
+        <th>Mimetypes</th>
+      </tr>{html_rows}
+    </table>
+  </div>
+  <!-- TABLE TREND END -->
+  """
+        return html_table
+
+    # plots files, size and the count of the top mimetypes over time (headless, see plotting.py)
+    def create_trend_plots(self, dir="output", top=10, formats=("png",), log=False, dpi=100):
+        from plotting import new_figure, save_figures, scale_axis
+
+        snapshots = self.snapshots()
+        if not snapshots:
+            return []
+        dates = [datetime.strptime(date, "%Y-%m-%d") for date, stats in snapshots]
+        last = snapshots[-1][1]["Mimetypes"]
+        top_mimetypes = sorted(last, key=lambda x: last[x]["count"], reverse=True)[:top]
+
+        fig, axes = new_figure(rows=3, size=(12, 15), sharex=True)
+        axes[0].plot(dates, [stats["resource_count"] for date, stats in snapshots], marker='o')
+        axes[0].set_ylabel('Files')
+        axes[1].plot(dates, [stats["TotalSize"] / 1024 / 1024 / 1024 for date, stats in snapshots], marker='o')
+        axes[1].set_ylabel('Size (GB)')
+        for mimetype in top_mimetypes:
+            axes[2].plot(dates, [stats["Mimetypes"].get(mimetype, {}).get("count", 0) for date, stats in snapshots],
+                marker='o', label=mimetype)
+        axes[2].set_ylabel('Count')
+        axes[2].legend(loc="upper left", fontsize="small")
+        for ax in axes:
+            scale_axis(ax, log)
+        fig.autofmt_xdate()
+        return save_figures({"trend_plot": fig}, dir, formats, dpi)
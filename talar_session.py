@@ -0,0 +1,68 @@
+import requests
+import threading
+
+from datetime import datetime
+
+
+LOGIN_URL = "https://talar.sfb833.uni-tuebingen.de/erdora/login"
+
+
+# logged in TALAR session shared by the checks of repo_eval.py and check_acl.py:
+# login, hourly re-login, retries and the error collection (keyed by CMDI handle)
+class TalarSession:
+
+    def __init__(self, username, password, workers=1):
+        self.username = username
+        self.password = password
+        self.session_start = datetime.now()
+        self.errors = {}
+        # number of requests running at the same time
+        self.workers = max(1, workers)
+        self._lock = threading.RLock()
+
+    def login(self):
+        with self._lock:
+            with requests.Session() as session:
+                # keep enough connections alive for every worker
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                post = session.post(LOGIN_URL,
+                    data = {"username": self.username, "password": self.password})
+                self.session = session
+
+    def _session_duration(self):
+        with self._lock:
+            now = datetime.now()
+            diff = now - self.session_start
+            if diff.total_seconds()/3600 >= 1:
+                self.session_start = datetime.now()
+                self.login()
+
+    # sometimes the connection to TALAR is suddenly lost
+    # try connecting to an URL at least 3 times;
+    # fetch(url) replaces the plain GET request, e.g. to download a resource
+    def connect_to_URL(self, url, fetch=None):
+        for i in range(3):
+            try:
+                if fetch is not None:
+                    return fetch(url)
+                r = self.session.get(url)
+                assert(r.status_code != 404)
+                return r
+            except Exception:
+                print("URL failure")
+                self.login()
+                continue
+        self.add_error(f"{url};404", url)
+        print(f"{url};404")
+
+    def add_error(self, error, cmdi):
+        if '@' in cmdi:
+            cmdi_handle = cmdi.split('@')[0]
+        else:
+            cmdi_handle = cmdi
+        with self._lock:
+            if self.errors.get(cmdi_handle) is None:
+                self.errors[cmdi_handle] = []
+            self.errors[cmdi_handle].append(error)
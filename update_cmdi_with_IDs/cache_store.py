@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+
+from unicodedata import normalize
+
+
+# backends of the authority ID cache (name -> set of (id, issuingAuthority)):
+# JSONCache keeps the whole cache.json in memory, SQLiteCache is an indexed file that is
+# only opened on first use and answers single lookups without loading everything;
+# both have get(), update() (bulk upsert), items(), index(), clear(), save()
+
+class SetEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def cache_to_file(output, cache):
+    with open(output + ".tmp", 'w', encoding="utf-8") as out_f:
+        json.dump(cache, out_f, cls=SetEncoder)
+    os.replace(output + ".tmp", output)
+
+def load_cache(input):
+    cache = {}
+    with open(input, 'r', encoding="utf-8") as in_f:
+        tmp = json.load(in_f)
+    for k, v in tmp.items():
+        s = set()
+        for i in v:
+            s.add((i[0], i[1]))
+        cache[k] = s
+    return cache
+
+
+def merge_cache(cache, partial):
+    for name, ids in partial.items():
+        if name not in cache:
+            cache[name] = set()
+        cache[name].update(ids)
+
+
+# normalized key of a name: Unicode NFKC, case folded, "Last, First" turned into "First Last"
+# and without punctuation, so "Hinrichs, Erhard", "erhard hinrichs" and "Erhard  Hinrichs" are
+# the same; other orders are not, "Li Wei" and "Wei Li" can be different persons
+def name_key(name):
+    name = normalize("NFKC", name).casefold()
+    if name.count(",") == 1:
+        last, first = name.split(",")
+        name = first + " " + last
+    return " ".join(re.sub(r"[,;.]", " ", name).split())
+
+
+# index of the cache by the normalized name; a name is only matched through its key if the key
+# belongs to exactly one cached name, otherwise only the exact name is looked up
+class NameIndex:
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.index = {}
+        for name in cache:
+            key = name_key(name)
+            if key not in self.index:
+                self.index[key] = []
+            self.index[key].append(name)
+
+    # returns the set of (id, issuingAuthority) of a name, None if unknown
+    def get(self, name):
+        names = self.index.get(name_key(name), [])
+        if len(names) == 1:
+            return self.cache[names[0]]
+        return self.cache.get(name)
+
+    def __len__(self):
+        return len(self.index)
+
+
+# returns the backend for the file extension: .sqlite/.db or JSON
+def open_cache(file):
+    if file.endswith((".sqlite", ".db")):
+        return SQLiteCache(file)
+    return JSONCache(file)
+
+
+class JSONCache:
+
+    def __init__(self, file="cache.json"):
+        self.file = file
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = load_cache(self.file) if os.path.exists(self.file) else {}
+        return self._cache
+
+    def get(self, name):
+        return self.cache.get(name)
+
+    def update(self, partial):
+        merge_cache(self.cache, partial)
+
+    def items(self):
+        return self.cache.items()
+
+    def index(self):
+        return NameIndex(self.cache)
+
+    def clear(self):
+        self._cache = {}
+
+    def save(self):
+        cache_to_file(self.file, self.cache)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class SQLiteCache:
+
+    def __init__(self, file="cache.sqlite"):
+        self.file = file
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.file)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, key TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS names_key ON names (key)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS ids (name TEXT, id TEXT, authority TEXT)")
+            self._connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ids_name ON ids (name, id, ifnull(authority, ''))")
+        return self._connection
+
+    # returns the set of (id, issuingAuthority) of the exact name, None if unknown
+    def get(self, name):
+        if self.connection.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone() is None:
+            return None
+        return set(self.connection.execute("SELECT id, authority FROM ids WHERE name = ?", (name,)))
+
+    # returns the IDs of the only cached name with the same normalized key (see name_key),
+    # if there is none or several, the IDs of the exact name
+    def get_normalized(self, name):
+        names = self.connection.execute("SELECT name FROM names WHERE key = ? LIMIT 2", (name_key(name),)).fetchall()
+        if len(names) == 1:
+            return self.get(names[0][0])
+        return self.get(name)
+
+    # bulk upsert of a (partial) cache
+    def update(self, partial):
+        self.connection.executemany("INSERT OR IGNORE INTO names VALUES (?, ?)",
+            [(name, name_key(name)) for name in partial])
+        self.connection.executemany("INSERT OR IGNORE INTO ids VALUES (?, ?, ?)",
+            [(name, a_id, iss_auth) for name, ids in partial.items() for a_id, iss_auth in ids])
+
+    def items(self):
+        ids = {}
+        for name, a_id, iss_auth in self.connection.execute("SELECT name, id, authority FROM ids"):
+            if name not in ids:
+                ids[name] = set()
+            ids[name].add((a_id, iss_auth))
+        for (name,) in self.connection.execute("SELECT name FROM names"):
+            yield name, ids.get(name, set())
+
+    # lookups go directly to the indexed key column
+    def index(self):
+        return _SQLiteIndex(self)
+
+    def clear(self):
+        self.connection.execute("DELETE FROM names")
+        self.connection.execute("DELETE FROM ids")
+
+    def save(self):
+        self.connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+
+
+class _SQLiteIndex:
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, name):
+        return self.cache.get_normalized(name)
+
+
+# converts between the backends, e.g. cache.json -> cache.sqlite or back
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import/export the authority ID cache between JSON and SQLite")
+    parser.add_argument("source", help="cache to read (.json, .sqlite/.db)")
+    parser.add_argument("target", help="cache to write (.json, .sqlite/.db), existing entries are kept")
+    args = parser.parse_args()
+
+    source = open_cache(args.source)
+    target = open_cache(args.target)
+    target.update(dict(source.items()))
+    target.save()
+    print(len(target))
@@ -1,15 +1,18 @@
 #import xml.etree.ElementTree as ET
 from lxml import etree as ET
+import hashlib
 import json
 import re
 import argparse
 import os
+import sys
 
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
+from multiprocessing import Pool, cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fs_scan import scan
+# load_cache/cache_to_file/merge_cache are still importable from here
+from cache_store import cache_to_file, load_cache, merge_cache, open_cache
 
 
 def read_cmdi(cmdi_path):
@@ -30,61 +33,157 @@ def read_cmdi_fromsource(cmdi_source):
     return tree
 
 
+# joins the text of all children with "name" or "agency" in their tag (e.g. firstName, lastName)
 def get_name(node):
-    name = ""
-    for child in node:
-        if "name" in child.tag.lower() or "agency" in child.tag.lower():
-            if name != "":
-                name += " " + child.text
-            else:
-                if child.text:
-                    name += child.text
-    if name == "":
+    parts = []
+    for child in node.iterchildren(ET.Element):
+        tag = ET.QName(child).localname.lower()
+        if ("name" in tag or "agency" in tag) and child.text and child.text.strip():
+            parts.append(child.text.strip())
+    if not parts:
         return None
-    return name.strip()
+    return " ".join(parts)
 
 def add_name(cache, name):
     if name not in cache and name is not None:
         cache[name] = set()
-                          
+
+ENTITIES = ("Person", "Author", "Organisation")
+
+# walks the document once: every entity (Person, Author, Organisation) is added with its name
+# and every AuthoritativeID is added to all entities it is nested in
 def cmdi_to_cache(cmdi, cache):
-    tags = ["Person", "Author", "Organisation"]
-    for tag in tags:
-        print(tag)
-        for entity in cmdi.xpath(f".//*[local-name()='{tag}']"):
-            name = get_name(entity)
+    names = {}
+    for elem in cmdi.iter(ET.Element):
+        tag = ET.QName(elem).localname
+        if tag in ENTITIES:
+            name = get_name(elem)
             add_name(cache, name)
-            for auth_id in entity.xpath(".//*[local-name()='AuthoritativeID']"):
-                a_id = auth_id.xpath("./*[local-name()='id']")
-                if len(a_id) > 0: a_id = a_id[0].text
-                
-                iss_auth = auth_id.xpath("./*[local-name()='issuingAuthority']")
-                if len(iss_auth) > 0: 
-                    iss_auth = iss_auth[0].text
-                else:
-                    iss_auth = ""
-                
-                if type(a_id) == type(""):
-                    cache[name].add((a_id, iss_auth))
+            names[elem] = name
+        elif tag == "AuthoritativeID":
+            auth_id = get_auth_id(elem)
+            if auth_id is None:
+                continue
+            for entity in elem.iterancestors(ET.Element):
+                name = names.get(entity)
+                if name is not None:
+                    cache[name].add(auth_id)
+
+
+# returns (id, issuingAuthority) of an AuthoritativeID, None if it has no id
+def get_auth_id(auth_id):
+    a_id = None
+    iss_auth = ""
+    for child in auth_id.iterchildren(ET.Element):
+        tag = ET.QName(child).localname
+        if tag == "id" and a_id is None:
+            a_id = child.text
+        elif tag == "issuingAuthority" and iss_auth == "":
+            iss_auth = child.text
+    if a_id is None:
+        return None
+    return (a_id, iss_auth)
 
-    #print(cache)
-    
 
-def cache_to_file(output, cache):
-    with open(output, 'w', encoding="utf-8") as out_f:
-        json.dump(cache, out_f, cls=SetEncoder)
-        
-def load_cache(input):
+# process pool worker: returns the partial cache (name -> set of IDs) of a single CMDI file
+def extract_file(path):
+    cmdi = read_cmdi(path)
+    if isinstance(cmdi, str):
+        print(f"{path}: {cmdi}")
+        return {}
     cache = {}
-    with open(input, 'r', encoding="utf-8") as in_f:
-        tmp = json.load(in_f)
-    for k, v in tmp.items():
-        s = set()
-        for i in v:
-            s.add((i[0], i[1]))
-        cache[k] = s
+    cmdi_to_cache(cmdi, cache)
+    return cache
+
+
+# extracts the entities of all CMDI files with a pool of processes and merges them into cache
+# (a backend from cache_store.py)
+def extract_all(paths, cache, processes=None):
+    if processes == 1:
+        for path in paths:
+            cache.update(extract_file(path))
+        return cache
+
+    with Pool(processes or cpu_count()) as pool:
+        for partial in pool.imap_unordered(extract_file, paths, chunksize=16):
+            cache.update(partial)
+    return cache
+
+
+# extracts the entities of CMDIs parsed elsewhere, e.g. oai_splitter.iter_cmdis()
+def extract_cmdis(cmdis, cache):
+    for handle, cmdi in cmdis:
+        partial = {}
+        cmdi_to_cache(cmdi, partial)
+        cache.update(partial)
     return cache
 
+
+# process pool worker for the incremental mode: job is (path, content hash of the last run);
+# returns (path, content hash, partial cache), the partial cache is None if the content didn't change
+def extract_changed(job):
+    path, old_hash = job
+    with open(path, 'rb') as in_f:
+        content = in_f.read()
+    content_hash = hashlib.sha1(content).hexdigest()
+    if content_hash == old_hash:
+        return path, content_hash, None
+    try:
+        cmdi = read_cmdi_fromsource(content)
+    except ET.ParseError as e:
+        print(f"{path}: {e}")
+        return path, content_hash, {}
+    cache = {}
+    cmdi_to_cache(cmdi, cache)
+    return path, content_hash, cache
+
+
+# only extracts CMDI files that are new or changed since the last run;
+# files: {path: {"mtime": .., "size": .., "hash": ..}} of the last run (see load_files),
+# returns the file states of this run
+def extract_incremental(paths_stats, cache, files, processes=None):
+    new_files = {}
+    jobs = []
+    for path, file_stat in paths_stats:
+        state = files.get(path)
+        new_files[path] = state
+        if state is not None and state["mtime"] == file_stat.st_mtime and state["size"] == file_stat.st_size:
+            continue
+        new_files[path] = {"mtime": file_stat.st_mtime, "size": file_stat.st_size, "hash": None}
+        jobs.append((path, state["hash"] if state is not None else None))
+
+    if processes == 1:
+        changed = _merge_changed(map(extract_changed, jobs), cache, new_files)
+    else:
+        with Pool(processes or cpu_count()) as pool:
+            changed = _merge_changed(pool.imap_unordered(extract_changed, jobs, chunksize=16), cache, new_files)
+    print(f"{len(new_files)} CMDI files, {changed} new or changed")
+    return new_files
+
+
+def _merge_changed(results, cache, files):
+    changed = 0
+    for path, content_hash, partial in results:
+        files[path]["hash"] = content_hash
+        if partial is not None:
+            cache.update(partial)
+            changed += 1
+    return changed
+
+
+def load_files(input):
+    if not os.path.exists(input):
+        return {}
+    with open(input, 'r', encoding="utf-8") as in_f:
+        return json.load(in_f)
+
+
+def files_to_file(output, files):
+    with open(output + ".tmp", 'w', encoding="utf-8") as out_f:
+        json.dump(files, out_f)
+    os.replace(output + ".tmp", output)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_cache",
@@ -92,24 +191,37 @@ if __name__ == '__main__':
                              "no existing cache under the specified path, set the flac new_cache to create a new "
                              "cache. if the cache is already present do not set the flag. the cache will be used and "
                              "updated.", type=str)
-    parser.add_argument("cmdi_files", type=str,
+    parser.add_argument("cmdi_files", type=str, nargs='?',
                         help="the path to the directory that contains all cmdi files. can be a complex hierachy.")
+    parser.add_argument("--oai", help="read the CMDIs from an OAI ListRecords dump (OAI.xml) instead of a directory")
     parser.add_argument("--new_cache", help="set this flag if you want to create a new cache",
                         action="store_true")
+    parser.add_argument("-j", "--processes", type=int,
+                        help="number of processes parsing CMDI files (default: number of CPUs, 1: no pool)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only parse CMDI files that are new or changed since the last run (mtime and content "
+                             "hash are stored next to the cache in PATH_TO_CACHE.files.json)")
     args = parser.parse_args()
     
+    # PATH_TO_CACHE.sqlite (or .db) uses the SQLite backend, otherwise JSON (see cache_store.py)
+    cache = open_cache(args.path_to_cache)
     if args.new_cache:
-        cache = {}
-    else:
-        cache_to_file(args.path_to_cache)
+        cache.clear()
     
-    for subdir, dirs, files in os.walk(args.cmdi_files):
-        if files:
-            for file in files:
-                cmdi = read_cmdi(subdir + "/" + file)
-                print(file)
-                cmdi_to_cache(cmdi, cache)
+    if args.oai is not None:
+        from oai_harvester import iter_records
+        from oai_splitter import iter_cmdis
+        extract_cmdis(iter_cmdis(iter_records(args.oai)), cache)
+    elif args.cmdi_files is None:
+        parser.error("either cmdi_files or --oai is required")
+    elif args.incremental:
+        files_path = args.path_to_cache + ".files.json"
+        files = {} if args.new_cache else load_files(files_path)
+        files = extract_incremental(scan(args.cmdi_files), cache, files, args.processes)
+        files_to_file(files_path, files)
+    else:
+        extract_all((path for path, file_stat in scan(args.cmdi_files)), cache, args.processes)
                 
-    cache_to_file(args.path_to_cache, cache)
+    cache.save()
     print(len(cache))
     
\ No newline at end of file
@@ -1,13 +1,18 @@
-from cmdi_extractor import load_cache, read_cmdi, get_name
-from unicodedata import name
+from cache_store import open_cache
+from cmdi_extractor import ENTITIES, read_cmdi, get_name
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree as ET
 import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fs_scan import scan
 
 
 def add_id(parent_node, cur_ids, namespace, cache_ids):
-    # if ID not already in CMDI, add it from the cache
-    for id_tuple in cache_ids:
+    # if ID not already in CMDI, add it from the cache (sorted, so the output is the same on every run)
+    for id_tuple in sorted(cache_ids, key=lambda x: (x[0], x[1] or "")):
         id = id_tuple[0]
         issuing_auth = id_tuple[1]
         
@@ -19,35 +24,76 @@ def add_id(parent_node, cur_ids, namespace, cache_ids):
         auth_id_child2 = ET.SubElement(auth_id, "{"+namespace+"}issuingAuthority").text = issuing_auth
 
 
+# cache: index() of a cache backend (or the plain cache dict for exact names)
 def cache_to_cmdi(cmdi, cache):
-    tags = ["Person", "Author", "Organisation"]
-    for tag in tags:
-        for entity in cmdi.xpath(f".//*[local-name()='{tag}']"):
-            namespace = entity.tag.split('}')[0][1:]
-            name = get_name(entity)
-            
-            # skip if no name/no authoritative IDs in cache
-            if name not in cache:
-                continue
-            auth_ids = cache[name]
-            if len(auth_ids) == 0:
-                continue
-            
-            parent_auth = entity.xpath(".//*[local-name()='AuthoritativeIDs']")
-            
-            # create <AuthoritativeIDs> if necessary
-            if len(parent_auth) == 0:
-                auths_ids_tag = ET.SubElement(entity, "{"+namespace+"}AuthoritativeIDs")
-            else:
-                auths_ids_tag = parent_auth[0]
-                
-            # get IDs already in CMDI
-            cur_ids = []
-            for id_node in auths_ids_tag.xpath(".//*[local-name()='id']"):
-                if id_node.text is not None:
-                    cur_ids.append(id_node.text)
+    # collected first, AuthoritativeIDs are added while going through the entities
+    entities = [elem for elem in cmdi.iter(ET.Element) if ET.QName(elem).localname in ENTITIES]
+    for entity in entities:
+        namespace = entity.tag.split('}')[0][1:]
+        name = get_name(entity)
+        
+        # skip if no name/no authoritative IDs in cache
+        if name is None:
+            continue
+        auth_ids = cache.get(name)
+        if not auth_ids:
+            continue
+        
+        parent_auth = entity.xpath(".//*[local-name()='AuthoritativeIDs']")
+        
+        # create <AuthoritativeIDs> if necessary
+        if len(parent_auth) == 0:
+            auths_ids_tag = ET.SubElement(entity, "{"+namespace+"}AuthoritativeIDs")
+        else:
+            auths_ids_tag = parent_auth[0]
             
-            add_id(auths_ids_tag, cur_ids, namespace, auth_ids)
+        # get IDs already in CMDI
+        cur_ids = set()
+        for id_node in auths_ids_tag.xpath(".//*[local-name()='id']"):
+            if id_node.text is not None:
+                cur_ids.add(id_node.text)
+        
+        add_id(auths_ids_tag, cur_ids, namespace, auth_ids)
+
+
+# collects the serialized CMDIs and writes them in batches with a few threads;
+# only files whose content differs are written, each one atomically (temp file + rename)
+class BatchWriter:
+
+    def __init__(self, batch_size=100, threads=4):
+        self.batch_size = batch_size
+        self.batch = []
+        self.written = 0
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def add(self, cmdi, path):
+        self.batch.append((ET.tostring(ET.ElementTree(cmdi), pretty_print=True, encoding="utf-8"), path))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for path in self.executor.map(lambda x: write_if_changed(*x), self.batch):
+            if path is not None:
+                print(path)
+                self.written += 1
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+
+# returns the path if the file was written, None if it already has this content
+def write_if_changed(content, path):
+    if os.path.exists(path):
+        with open(path, 'rb') as in_f:
+            if in_f.read() == content:
+                return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as out_f:
+        out_f.write(content)
+    os.replace(path + ".tmp", path)
+    return path
 
 
 if __name__ == '__main__':
@@ -58,19 +104,19 @@ if __name__ == '__main__':
                         help="the path to the directory that contains all cmdi files. can be a complex hierachy.")
     args = parser.parse_args()
 
-    cache = load_cache(args.path_to_cache)
+    # the JSON cache is loaded into a NameIndex, the SQLite cache is queried per name
+    index = open_cache(args.path_to_cache).index()
+    writer = BatchWriter()
     c = 0
     # traverse through directory structure
-    for subdir, dirs, files in os.walk(args.cmdi_files):
-        if files:
-            for file in files:
-                cmdi = read_cmdi(subdir + "/" + file)
-                cache_to_cmdi(cmdi, cache)
-                # create the path (mirroring the original one) and save the modified CMDI there
-                new_save_path = "updated_cmdis" + "/" + subdir[len(args.cmdi_files):] + "/" + file
-                os.makedirs(os.path.dirname(new_save_path), exist_ok=True)
-                et = ET.ElementTree(cmdi)
-                et.write(new_save_path, pretty_print=True, encoding="utf-8")
-                print(new_save_path)
-                c += 1
-    print("CMDIs found:", c)
\ No newline at end of file
+    for path, file_stat in scan(args.cmdi_files):
+        cmdi = read_cmdi(path)
+        cache_to_cmdi(cmdi, index)
+        # create the path (mirroring the original one) and save the modified CMDI there,
+        # unchanged files are not written again
+        new_save_path = os.path.join("updated_cmdis", os.path.relpath(path, os.path.abspath(args.cmdi_files)))
+        writer.add(cmdi, new_save_path)
+        c += 1
+    writer.close()
+    print("CMDIs found:", c)
+    print("CMDIs written:", writer.written)
\ No newline at end of file
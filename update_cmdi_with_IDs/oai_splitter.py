@@ -0,0 +1,78 @@
+from lxml import etree as ET
+from urllib.parse import urlparse
+import argparse
+import copy
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from bounded_pool import bounded_map
+from cmdi_extractor import read_cmdi_fromsource
+from oai_harvester import OAI_NS, OAIHarvester, iter_records
+
+
+CMD_NS = "http://www.clarin.eu/cmd/1"
+
+
+# yields (MdSelfLink, serialized CMD) of every record, records are streamed by the
+# harvester (iterparse), so only the current record is in memory
+def cmdi_payloads(records):
+    for record in records:
+        metadata = record.find("{" + OAI_NS + "}metadata")
+        if metadata is None or len(metadata) == 0:
+            continue
+        # a standalone copy without the unused OAI namespace declarations
+        cmd = copy.deepcopy(metadata[0])
+        ET.cleanup_namespaces(cmd)
+        handle = cmd.findtext(".//{" + CMD_NS + "}MdSelfLink")
+        if handle is None:
+            continue
+        yield handle.strip(), ET.tostring(cmd, encoding="utf-8")
+
+
+# yields (MdSelfLink, parsed CMDI) of every record without writing any file,
+# e.g. for cmdi_extractor.cmdi_to_cache
+def iter_cmdis(records):
+    for handle, payload in cmdi_payloads(records):
+        yield handle, read_cmdi_fromsource(payload)
+
+
+# relative file path of a CMDI from its MdSelfLink,
+# e.g. http://hdl.handle.net/11022/0000-0000-1234-5@format=cmdi -> 11022/0000-0000-1234-5.xml
+def handle_path(handle):
+    path = urlparse(handle).path if "://" in handle else handle
+    path = path.split('@')[0]
+    parts = [re.sub(r"[^A-Za-z0-9._-]", "_", part) for part in path.split('/')]
+    parts = [part for part in parts if part not in ("", ".", "..")]
+    return os.path.join(*parts) + ".xml"
+
+
+def _write(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as out_f:
+        out_f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_f.write(payload)
+    os.replace(path + ".tmp", path)
+
+
+# writes the CMD of every record to output_dir/<handle_path> with a pool of writer threads,
+# returns the number of written files (failed writes are printed, not counted);
+# the number of payloads waiting to be written is bounded
+def split(records, output_dir="cmdis", workers=8):
+    files = ((os.path.join(output_dir, handle_path(handle)), payload) for handle, payload in cmdi_payloads(records))
+    return bounded_map(_write, files, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split an OAI ListRecords dump into one CMDI file per record')
+    parser.add_argument("-i", "--input", help="OAI.xml. If not defined, the records get harvested from TALAR")
+    parser.add_argument("-o", "--output", default="cmdis", help="Output directory")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of writer threads")
+    args = parser.parse_args()
+
+    if args.input is None:
+        records = OAIHarvester().records()
+    else:
+        records = iter_records(args.input)
+    print("CMDIs written:", split(records, args.output, args.workers))
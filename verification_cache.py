@@ -0,0 +1,82 @@
+import json
+import os
+import random
+import threading
+
+from datetime import datetime, timedelta
+
+
+# remembers the resolved URL, ETag/Last-Modified, size and checksums of every verified
+# resource, so unchanged resources can be skipped with a conditional request (304)
+class VerificationCache:
+
+    def __init__(self, file="output/verification_cache.json", recheck_ratio=0.05, max_age=30, evict_after=90):
+        self.file = file
+        # share of cached resources that get downloaded and hashed again anyway,
+        # so bit rot is still caught over time
+        self.recheck_ratio = recheck_ratio
+        # days after which a resource is always downloaded and hashed again
+        self.max_age = timedelta(days=max_age)
+        # days after which an entry that was not used anymore gets removed
+        self.evict_after = timedelta(days=evict_after)
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as in_f:
+                self.entries = json.load(in_f)
+
+    # returns the cached entry if a conditional request can be used for the resource
+    def get(self, res_handle):
+        with self._lock:
+            entry = self.entries.get(res_handle)
+        if entry is None or (entry["etag"] is None and entry["last_modified"] is None):
+            return None
+
+        checked = datetime.fromisoformat(entry["checked"])
+        if datetime.now() - checked > self.max_age or random.random() < self.recheck_ratio:
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    # returns size and checksums of the cached entry for an unchanged (304) resource
+    def hit(self, res_handle):
+        with self._lock:
+            entry = self.entries[res_handle]
+            entry["seen"] = datetime.now().isoformat()
+        return {k: entry[k] for k in ("size", "md5", "sha1", "sha256")}
+
+    def put(self, res_handle, url, headers, calc_checksums):
+        now = datetime.now().isoformat()
+        entry = {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+            "checked": now, "seen": now}
+        entry.update(calc_checksums)
+        with self._lock:
+            self.entries[res_handle] = entry
+
+    def remove(self, res_handle):
+        with self._lock:
+            self.entries.pop(res_handle, None)
+
+    # entries that were not used for evict_after days are not written back
+    def save(self):
+        now = datetime.now()
+        with self._lock:
+            self.entries = {k: v for k, v in self.entries.items()
+                if now - datetime.fromisoformat(v["seen"]) <= self.evict_after}
+            entries = dict(self.entries)
+
+        dir = os.path.dirname(self.file)
+        if dir != "" and not os.path.exists(dir):
+            os.makedirs(dir)
+
+        with open(self.file + ".tmp", 'w', encoding="utf-8") as out_f:
+            json.dump(entries, out_f)
+        os.replace(self.file + ".tmp", self.file)